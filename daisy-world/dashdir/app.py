@@ -6,13 +6,16 @@
 
 import dash
 from dash import dcc, html, callback_context
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 import copy
 import json
+import logging
+import os
 
 import plotting as plot
 import calculations as calc
-from flask import Flask
+import lattice
+from flask import Flask, abort, jsonify, request
 
 
 # Dashboard preliminaries:
@@ -20,8 +23,7 @@ es = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
 
 
 server = Flask(__name__)
-app = dash.Dash(__name__,server=server,
-                requests_pathname_prefix='/daisy/')
+app = dash.Dash(__name__, server=server, requests_pathname_prefix="/daisy/")
 
 # Load any markdown files to insert into the app:
 instructions = open("./assets/instructions.md", "r")
@@ -34,8 +36,41 @@ attributions_md = attributions.read()
 with open("init_vars.json") as infile:
     init_vars = json.load(infile)
 
-# Deepcopy of init_vars for callbacks:
-live_vars = copy.deepcopy(init_vars)
+
+# Parameters of one callback: a fresh copy of init_vars with the slider
+# values, so concurrent requests never share a parameter dict
+def slider_vars(Aw, Ab, Ap, ins, distance=1):
+    the_dict = copy.deepcopy(init_vars)
+    the_dict["Albedo"]["w"] = Aw
+    the_dict["Albedo"]["b"] = Ab
+    the_dict["Albedo"]["none"] = Ap
+    the_dict["ins_p"] = ins
+    the_dict["Fsnom"] = calc.update_solar_constant(calc.fromAU(distance))
+    return the_dict
+
+
+# Serve the tab 2 sweeps from the precomputed slider lattice when it has been
+# built (python lattice.py), anything off the lattice is still computed:
+if os.path.isdir(lattice.DEFAULT_DIR):
+    calc.simulation_cache.lattice = lattice.Lattice(lattice.DEFAULT_DIR)
+
+# Run the forward and backward sweeps of tab 2 in a process pool while the
+# callback does the barren planet sweep:
+calc.parallel_sweeps = True
+
+# One json log line with the solver statistics of every figure callback:
+logging.basicConfig(level=logging.INFO)
+
+
+# Solver statistics of the recent callbacks, for local requests only:
+@server.route("/metrics")
+def metrics():
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(403)
+    return jsonify(
+        cache=calc.simulation_cache.stats(), callbacks=list(calc.recent_stats)
+    )
+
 
 # Function calls for initializing figures:
 constant_flux_temp = plot.constant_flux_temp(
@@ -177,13 +212,18 @@ app.layout = html.Div(
                                     style=slider_style,
                                 ),
                                 html.Button("Reset", id="reset_button", n_clicks=0),
-                                dcc.Graph(id="constant_flux_area"),
+                                dcc.Store(id="constant_flux_traces"),
+                                dcc.Graph(
+                                    id="constant_flux_area", figure=constant_flux_area
+                                ),
                             ],
                             style={"width": "100%", "display": "inline-block"},
                         ),
                         html.Div(
                             [
-                                dcc.Graph(id="constant_flux_temp"),
+                                dcc.Graph(
+                                    id="constant_flux_temp", figure=constant_flux_temp
+                                ),
                             ],
                             style={"width": "100%", "display": "inline-block"},
                         ),
@@ -267,8 +307,15 @@ app.layout = html.Div(
                                     style=slider_style,
                                 ),
                                 html.Button("Reset", id="reset_button_2", n_clicks=0),
-                                dcc.Graph(id="varying_solar_flux_area"),
-                                dcc.Graph(id="varying_solar_flux_temp"),
+                                dcc.Store(id="varying_solar_flux_traces"),
+                                dcc.Graph(
+                                    id="varying_solar_flux_area",
+                                    figure=varying_solar_flux_area,
+                                ),
+                                dcc.Graph(
+                                    id="varying_solar_flux_temp",
+                                    figure=varying_solar_flux_temp,
+                                ),
                             ],
                             style={"width": "100%", "display": "inline-block"},
                         ),
@@ -290,42 +337,55 @@ app.layout = html.Div(
                 "margin-left": 20,
             },
         ),
-        dcc.Store(id="tab1_vars", data={}, storage_type="memory"),
-        dcc.Store(id="tab2_vars", data={}, storage_type="memory"),
     ],
     style={"width": "1000px"},
 )
 
+# Copies of the temperature and area figures of a tab with the trace
+# properties sent by the server (see plotting.constant_flux_traces) put in,
+# so only the arrays that change with the sliders travel to the browser and
+# the layout and trace styles stay those of the figures on the page:
+update_figures = """
+function(traces, temp, area) {
+    function update(figure, changes) {
+        const data = figure.data.map(
+            (trace, i) => Object.assign({}, trace, changes[i])
+        );
+        return Object.assign({}, figure, {data: data});
+    }
+    return [update(temp, traces.temp), update(area, traces.area)];
+}
+"""
+
 #####################################################################
 # Tab 1 Callbacks
 #####################################################################
-# update memory .json live_vars (dcc.Store(id='tab1_vars)')
+# send the new trace arrays of both figures in one round trip:
 @app.callback(
-    Output(component_id="tab1_vars", component_property="data"),
+    Output(component_id="constant_flux_traces", component_property="data"),
     Input(component_id="Aw_1", component_property="value"),
     Input(component_id="Ab_1", component_property="value"),
     Input(component_id="Ap_1", component_property="value"),
     Input(component_id="ins_1", component_property="value"),
     Input(component_id="distance", component_property="value"),
 )
-def update_tab1_vars(Aw_1, Ab_1, Ap_1, ins_1, distance):
-    live_vars["Albedo"]["w"] = Aw_1
-    live_vars["Albedo"]["b"] = Ab_1
-    live_vars["Albedo"]["none"] = Ap_1
-    live_vars["ins_p"] = ins_1
-    live_vars["Fsnom"] = calc.update_solar_constant(calc.fromAU(distance))
-    return json.dumps(live_vars)  # return a json dict
+def update_tab1(Aw_1, Ab_1, Ap_1, ins_1, distance):
+    the_dict = slider_vars(Aw_1, Ab_1, Ap_1, ins_1, distance)
+    with calc.instrumented("update_tab1"):
+        _, temp, area = plot.constant_flux_traces(**the_dict)
+        return {"temp": temp, "area": area}
 
 
-# update figure using the jsonified tab1_vars:
-@app.callback(
+# and apply them in the browser:
+app.clientside_callback(
+    update_figures,
     Output(component_id="constant_flux_temp", component_property="figure"),
     Output(component_id="constant_flux_area", component_property="figure"),
-    Input("tab1_vars", "data"),
+    Input(component_id="constant_flux_traces", component_property="data"),
+    State(component_id="constant_flux_temp", component_property="figure"),
+    State(component_id="constant_flux_area", component_property="figure"),
+    prevent_initial_call=True,
 )
-def update_tab1(jsonified_tab1_vars):
-    the_dict = json.loads(jsonified_tab1_vars)
-    return plot.constant_flux_temp(**the_dict), plot.constant_flux_area(**the_dict)
 
 
 # reset sliders on button input:
@@ -350,33 +410,31 @@ def reset_tab1(n_clicks):
 #####################################################################
 # Tab 2 Callbacks
 #####################################################################
-# update memory .json live_vars (dcc.Store(id='tab2_vars)')
+# send the new trace arrays of both figures in one round trip:
 @app.callback(
-    Output(component_id="tab2_vars", component_property="data"),
+    Output(component_id="varying_solar_flux_traces", component_property="data"),
     Input(component_id="Aw_2", component_property="value"),
     Input(component_id="Ab_2", component_property="value"),
     Input(component_id="Ap_2", component_property="value"),
     Input(component_id="ins_2", component_property="value"),
 )
-def update_tab2_vars(Aw_2, Ab_2, Ap_2, ins_2):
-    live_vars["Albedo"]["w"] = Aw_2
-    live_vars["Albedo"]["b"] = Ab_2
-    live_vars["Albedo"]["none"] = Ap_2
-    live_vars["ins_p"] = ins_2
-    return json.dumps(live_vars)  # return a json dict
+def update_tab2(Aw_2, Ab_2, Ap_2, ins_2):
+    the_dict = slider_vars(Aw_2, Ab_2, Ap_2, ins_2)
+    with calc.instrumented("update_tab2"):
+        _, temp, area = plot.varying_solar_flux_traces(**the_dict)
+        return {"temp": temp, "area": area}
 
 
-# update the figures using the jsonified tab2_vars:
-@app.callback(
+# and apply them in the browser:
+app.clientside_callback(
+    update_figures,
     Output(component_id="varying_solar_flux_temp", component_property="figure"),
     Output(component_id="varying_solar_flux_area", component_property="figure"),
-    Input("tab2_vars", "data"),
+    Input(component_id="varying_solar_flux_traces", component_property="data"),
+    State(component_id="varying_solar_flux_temp", component_property="figure"),
+    State(component_id="varying_solar_flux_area", component_property="figure"),
+    prevent_initial_call=True,
 )
-def update_tab2(jsonified_tab2_vars):
-    the_dict = json.loads(jsonified_tab2_vars)
-    return plot.varying_solar_flux_temp(**the_dict), plot.varying_solar_flux_area(
-        **the_dict
-    )
 
 
 # Reset sliders on button input:
@@ -0,0 +1,177 @@
+# file batch_runner.py
+
+# Runs the Daisyworld experiments of calculations.py over a grid of
+# parameters without going through the Dash app, e.g. to prepare course
+# material or to precompute caches:
+#
+#     python batch_runner.py grid.json outdir [--chunk 256] [--workers 4]
+#
+# The grid file is json with the experiment ("constant_flux" or
+# "equi_flux") and the parameters that differ from init_vars.json. Lists
+# are grid axes and all their combinations are run; the dict valued
+# parameters (Albedo, death, T_min, T_opt, areas) take lists per entry.
+# "distance" (in AU) may be given instead of Fsnom, e.g.
+#
+#     {"experiment": "equi_flux",
+#      "params": {"Albedo": {"w": [0.6, 0.7, 0.8]}, "ins_p": [0, 0.25, 0.5]}}
+#
+# The grid points are split into chunks, each chunk is run as one batch
+# (see update_equi_flux_batch) on a process pool, and every finished chunk
+# is written straight away as outdir/chunk_NNNNN.npz. A chunk holds one
+# column per grid axis (named like "Albedo.w") and the model states with
+# the grid points along the first axis. outdir/meta.json describes the run.
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import calculations as calc
+
+# batched experiment and the names of the arrays it returns
+EXPERIMENTS = {
+    "constant_flux": (calc.update_constant_flux_batch, ["xgens"]),
+    "equi_flux": (calc.update_equi_flux_batch, ["xeq", "xeqbar", "xeqinv"]),
+}
+
+# names of the state vector columns, in order
+COLUMNS = ["Sw", "Sb", "Su", "Ap", "Tp", "Tw", "Tb", "status"]
+
+# initial daisy areas of the constant flux experiment (as in plotting.py)
+AREAS = {"w": 0.01, "b": 0.01}
+
+
+def _flatten(params, prefix=""):
+    # {"Albedo": {"w": 0.7}} -> {"Albedo.w": 0.7}
+    flat = {}
+    for k, v in params.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + "."))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def _set(params, name, value):
+    # set a (possibly nested, "Albedo.w") parameter
+    *path, key = name.split(".")
+    for k in path:
+        params = params.setdefault(k, {})
+    params[key] = value
+
+
+def load_grid(path, init_vars):
+    # the experiment, the fixed parameters and the grid axes of a grid file
+    with open(path) as infile:
+        grid = json.load(infile)
+    experiment = grid["experiment"]
+    if experiment not in EXPERIMENTS:
+        raise ValueError("unknown experiment: " + str(experiment))
+
+    base = json.loads(json.dumps(init_vars))
+    if experiment == "constant_flux":
+        base["areas"] = dict(AREAS)
+    axes = {}
+    for name, value in _flatten(grid.get("params", {})).items():
+        if isinstance(value, list):
+            axes[name] = np.asarray(value, dtype=float)
+        else:
+            _set(base, name, value)
+    return experiment, base, axes
+
+
+def grid_points(axes):
+    # one flat column per axis, running over all combinations of the axes
+    names = list(axes)
+    if not names:
+        return {}
+    mesh = np.meshgrid(*[axes[n] for n in names], indexing="ij")
+    return {n: m.ravel() for n, m in zip(names, mesh)}
+
+
+def _params(base, columns):
+    # parameters of a chunk, with an array for every grid axis
+    params = json.loads(json.dumps(base))
+    for name, values in columns.items():
+        _set(params, name, values)
+    distance = params.pop("distance", None)
+    if distance is not None:
+        params["Fsnom"] = calc.update_solar_constant(calc.fromAU(np.asarray(distance)))
+    return params
+
+
+def run_chunk(experiment, base, columns):
+    # run one chunk of grid points as a single batch; the results have
+    # the grid points along the first axis
+    func, names = EXPERIMENTS[experiment]
+    result = func(**_params(base, columns))
+    return {n: np.moveaxis(r, 1, 0) for n, r in zip(names, result)}
+
+
+def run(gridfile, outdir, init_vars, chunk=256, workers=None):
+    experiment, base, axes = load_grid(gridfile, init_vars)
+    points = grid_points(axes)
+    npoints = len(next(iter(points.values()))) if points else 1
+    starts = range(0, npoints, chunk)
+    chunks = [{n: v[s : s + chunk] for n, v in points.items()} for s in starts]
+
+    os.makedirs(outdir, exist_ok=True)
+    meta = {
+        "experiment": experiment,
+        "params": base,
+        "axes": {n: v.tolist() for n, v in axes.items()},
+        "columns": COLUMNS,
+        "npoints": npoints,
+        "nchunks": len(chunks),
+    }
+    if experiment == "equi_flux":
+        meta["F"] = calc.solar_flux_fractions().tolist()
+    with open(os.path.join(outdir, "meta.json"), "w") as outfile:
+        json.dump(meta, outfile, indent=1)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            run_chunk,
+            [experiment] * len(chunks),
+            [base] * len(chunks),
+            chunks,
+        )
+        # the chunks come back in order, each is written as soon as it is done
+        for i, (columns, result) in enumerate(zip(chunks, results)):
+            np.savez(
+                os.path.join(outdir, "chunk_{:05d}.npz".format(i)), **columns, **result
+            )
+            print("chunk", i + 1, "of", len(chunks), "done")
+    return meta
+
+
+def read(outdir):
+    # all chunks of a finished run, concatenated
+    with open(os.path.join(outdir, "meta.json")) as infile:
+        meta = json.load(infile)
+    parts = {}
+    for i in range(meta["nchunks"]):
+        with np.load(os.path.join(outdir, "chunk_{:05d}.npz".format(i))) as data:
+            for name in data.files:
+                parts.setdefault(name, []).append(data[name])
+    return meta, {n: np.concatenate(p) for n, p in parts.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run Daisyworld experiments over a parameter grid"
+    )
+    parser.add_argument("gridfile", help="json file with the parameter grid")
+    parser.add_argument("outdir", help="directory for the .npz chunks")
+    parser.add_argument("--chunk", type=int, default=256, help="grid points per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes")
+    parser.add_argument(
+        "--init-vars", default="init_vars.json", help="default parameters"
+    )
+    args = parser.parse_args()
+
+    with open(args.init_vars) as infile:
+        init_vars = json.load(infile)
+    run(args.gridfile, args.outdir, init_vars, chunk=args.chunk, workers=args.workers)
@@ -1,145 +1,1167 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
 import numpy as np
 
+# The state vector x is a numpy array of length NVARS. The entries are
+# addressed with the index constants below, so a sequence of states can be
+# stored as one preallocated array of shape (nsteps, NVARS) and sliced by column.
+# The update functions index with x[..., IDX], so they work on a single state
+# as well as on a batch of states of shape (nbatch, NVARS) with array valued
+# parameters. A single run is stepped on floats by state_kernels instead,
+# which avoids the numpy call overhead on one short vector and shares the
+# growth rate with DaisyGrowth.
+SW = 0  # area of white daisies
+SB = 1  # area of black daisies
+SU = 2  # uninhabited (barren) area
+AP = 3  # planetary albedo
+TP = 4  # planetary temperature
+TW = 5  # temperature of the white daisy regions
+TB = 6  # temperature of the black daisy regions
+ST = 7  # status of the equilibrium solver that produced the state (see below)
+NVARS = 8
+
+# solver status values stored in x[..., ST]
+CONVERGED = 0  # the temperature settled
+OSCILLATING = 1  # stuck in a cycle, the state is the average over one period
+MAXITER = 2  # gave up after the iteration budget
+
+# iteration budget of the equilibrium solvers, so that a parameter combination
+# which never settles cannot pin a worker, and the longest cycle we look for
+EQUI_MAXITER = 500
+EQUI_MAXPERIOD = 8
+# the relative loss of swing per period below which an oscillation counts
+# as a cycle (see _cycle_decays)
+CYCLE_DECAY = 0.01
+
+# the daisy types in the order of their (adjacent) areas and temperatures
+# in the state vector
+TYPES = ["w", "b"]
+AREAS = slice(SW, SB + 1)
+TEMPS = slice(TW, TB + 1)
+
+
+# The update functions work for any number of daisy species. A state vector
+# with n species holds the n areas, the barren area, the planetary albedo and
+# temperature, the n temperatures of the daisy regions and the solver status,
+# so for the two daisy types the columns are the constants above. The species
+# parameters are then arrays with one entry per species (see species_param).
+def species_layout(n):
+    # columns (areas, SU, AP, TP, temperatures, ST) of a state with n species
+    return slice(0, n), n, n + 1, n + 2, slice(n + 3, 2 * n + 3), 2 * n + 3
+
+
+def species_count(x):
+    # number of daisy species of a state vector (or an array of them)
+    return (x.shape[-1] - 4) // 2
+
+
+def new_species_state(S):
+    # initialize a state vector with the daisy areas S of any number of
+    # species (albedo and temperatures still need to be computed)
+    S = np.asarray(S, dtype=float)
+    areas, su, _, _, _, _ = species_layout(S.shape[-1])
+    x = np.zeros(S.shape[:-1] + (2 * S.shape[-1] + 4,))
+    x[..., areas] = S
+    x[..., su] = 1 - S.sum(axis=-1)
+    return x
+
+
+# Solver instrumentation. Inside a "with instrumented(name):" block (e.g. one
+# Dash callback) the solvers of this thread count the NextState calls, the
+# Equi_state iterations of every flux step, the steps that did not converge
+# and the wall time of the phases of each experiment, and the cache records
+# where the runs came from. The counters are a few attribute increments per
+# call, so they stay on in production; outside of such a block nothing is
+# recorded. Finished records are logged as one json line and kept (with the
+# iterations of every flux step) in recent_stats for the metrics endpoint of
+# the app.
+_local = threading.local()
+recent_stats = deque(maxlen=200)
+logger = logging.getLogger("daisyworld")
+
+
+class SolverStats:
+    def __init__(self, name):
+        self.name = name
+        self.nextstate = 0
+        self.equi_iterations = []
+        self.not_converged = 0
+        self.phases = {}
+        self.cache = {"hits": 0, "lattice": 0, "computed": 0}
+        self.wall = 0.0
+
+    def as_dict(self):
+        iters = self.equi_iterations
+        return {
+            "name": self.name,
+            "wall": round(self.wall, 6),
+            "nextstate_calls": self.nextstate,
+            "equi_steps": len(iters),
+            "equi_iterations": sum(iters),
+            "equi_iterations_max": max(iters, default=0),
+            "not_converged": self.not_converged,
+            "phases": {k: round(v, 6) for k, v in self.phases.items()},
+            "cache": dict(self.cache),
+        }
+
+
+def current_stats():
+    # the record of the enclosing instrumented block, or None
+    return getattr(_local, "stats", None)
+
+
+@contextmanager
+def instrumented(name):
+    stats = SolverStats(name)
+    outer = current_stats()
+    _local.stats = stats
+    t0 = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall = time.perf_counter() - t0
+        _local.stats = outer
+        record = stats.as_dict()
+        logger.info("solver_stats %s", json.dumps(record))
+        # the endpoint also gets the iterations of every flux step
+        record["equi_iterations_per_step"] = list(stats.equi_iterations)
+        recent_stats.append(record)
+
+
+@contextmanager
+def phase(name):
+    # add the wall time of the block to the current record
+    stats = current_stats()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            dt = time.perf_counter() - t0
+            stats.phases[name] = stats.phases.get(name, 0) + dt
+
+
+def _record_solve(niter, status):
+    # one equilibrium solve of niter iterations with final status
+    stats = current_stats()
+    if stats is not None:
+        stats.equi_iterations.append(niter)
+        stats.not_converged += int(np.count_nonzero(status != CONVERGED))
+
+
+def new_state(Sw, Sb):
+    # initialize a state vector with the given daisy areas
+    # (albedo and temperatures still need to be computed)
+    x = np.zeros(NVARS)
+    x[..., SW] = Sw
+    x[..., SB] = Sb
+    # compute barren area automatically
+    x[..., SU] = 1 - Sw - Sb
+    return x
+
 
 def UpdateAlbedo(x, Albedo):
-    # define a function which updates the planetary albedo of the state vector (last entry)
-    # Note that the state vector x is assumed to be a python dictionary
+    # define a function which updates the planetary albedo of the state vector
     # weighted sum of different planet cover
-    x["Ap"] = Albedo["none"] * x["Su"] + Albedo["w"] * x["Sw"] + Albedo["b"] * x["Sb"]
+    areas, su, ap, _, _, _ = species_layout(species_count(x))
+    x[..., ap] = Albedo["none"] * x[..., su] + (
+        species_param(Albedo, TYPES) * x[..., areas]
+    ).sum(axis=-1)
     return x
 
 
 def UpdateTemp(x, F, rat, em_p, sig, ins_p, Albedo):
     # function to update the state vector for the planetary temperature
+    _, _, ap, tp, temps, _ = species_layout(species_count(x))
 
     # outward flux of a planet with the average albedo (assume Black body)
-    Fp = F * (1 - x["Ap"]) * rat / em_p
+    Fp = F * (1 - x[..., ap]) * rat / em_p
 
     # invert Stefan Boltzmann's law
-    x["Tp"] = np.sqrt(np.sqrt((Fp / sig)))
+    x[..., tp] = np.sqrt(np.sqrt((Fp / sig)))
 
-    # now do the same for the regions with white and black daisies
-    Fw = F * (1 - Albedo["w"]) * rat / em_p
-    x["Tw"] = np.sqrt(np.sqrt((ins_p * (Fw - Fp) + Fp) / sig))
+    # now do the same for the regions of all daisy species at once
+    UpdateDaisyTemp(x, F, rat, em_p, sig, ins_p, Albedo, Fp)
+    return x
 
-    # now do the same for the regions with white and black daisies
-    Fb = F * (1 - Albedo["b"]) * rat / em_p
-    x["Tb"] = np.sqrt(np.sqrt((ins_p * (Fb - Fp) + Fp) / sig))
+
+def UpdateDaisyTemp(x, F, rat, em_p, sig, ins_p, Albedo, Fp):
+    # temperatures of the daisy regions, given the outward flux Fp of the
+    # planet (the per species values run along the last axis)
+    temps = species_layout(species_count(x))[4]
+    F = np.asarray(F)[..., None]
+    ins_p = np.asarray(ins_p)[..., None]
+    Fp = Fp[..., None]
+    Fd = F * (1 - species_param(Albedo, TYPES)) * rat / em_p
+    x[..., temps] = np.sqrt(np.sqrt((ins_p * (Fd - Fp) + Fp) / sig))
     return x
 
 
+def species_param(p, bwtype):
+    # look up a per species parameter (T_min, T_opt, death, ...). Parameters
+    # of the two daisy types are dicts, looked up for a single type or for a
+    # sequence of types which then runs along the last axis. Parameters of n
+    # species are arrays with the species along the last axis; for the
+    # albedo such an array is stored as Albedo["daisies"], next to the
+    # albedo of the bare ground Albedo["none"].
+    if not isinstance(p, dict):
+        return np.asarray(p, dtype=float)
+    if "daisies" in p:
+        return np.asarray(p["daisies"], dtype=float)
+    if isinstance(bwtype, str):
+        return p[bwtype]
+    values = np.broadcast_arrays(*[np.asarray(p[t], dtype=float) for t in bwtype])
+    return np.stack(values, axis=-1)
+
+
+def spectrum_params(n, Albedo, death, T_min, T_opt):
+    # species parameters of a spectrum of n daisy species with albedos
+    # evenly spaced between the black and the white daisies, sharing the
+    # (mean) death rate and temperature range of the two daisy types
+    def mean(p):
+        return np.full(n, np.mean(species_param(p, TYPES)))
+
+    return {
+        "Albedo": {
+            "none": Albedo["none"],
+            "daisies": np.linspace(Albedo["b"], Albedo["w"], n),
+        },
+        "death": mean(death),
+        "T_min": mean(T_min),
+        "T_opt": mean(T_opt),
+    }
+
+
 def DaisyGrowth(T, bwtype, T_min, T_opt):
-    Gw = 1 - ((T - T_opt[bwtype]) / (T_min[bwtype] - T_opt[bwtype])) ** 2
-    # set negative values to 0
-    if Gw < 0:
-        return 0
-    else:
-        return Gw
+    # growth rate of daisies of type bwtype at temperature T. With a sequence
+    # of types, e.g. T of shape (nt, 2) and bwtype ["w", "b"], all growth
+    # rates are computed in one pass
+    return growth_rate(T, species_param(T_min, bwtype), species_param(T_opt, bwtype))
+
+
+def growth_rate(T, Tmin, Topt):
+    # the growth rate of DaisyGrowth for looked up temperature ranges, on
+    # floats (see state_kernels) as well as on arrays
+    Gw = (T - Topt) / (Tmin - Topt)
+    Gw = 1 - Gw * Gw
+    # set negative values to 0 (max(Gw, 0), exactly, for both)
+    return (Gw + abs(Gw)) / 2
 
 
 # function to update areas based on growth rate and death rate
 def UpdateAreas(x, death, minarea, T_min, T_opt):
 
-    for Stype in ["w", "b"]:
-        grwth = DaisyGrowth(x["T" + Stype], Stype, T_min, T_opt)
-        ArType = "S" + Stype
-        Ds = x[ArType] * (grwth * x["Su"] - death[Stype])
-        # the following code applies 2 checks
-        # (1) keep the area to zero if it has been
-        # articifically set to exactly zero
-        if x[ArType] > 0:
-            x[ArType] += Ds
-            # (2) apply the minimum area if the area comes below the threshold
-            if x[ArType] < minarea:
-                x[ArType] = minarea
+    # all daisy species at once
+    areas, su, _, _, temps, _ = species_layout(species_count(x))
+    grwth = DaisyGrowth(x[..., temps], TYPES, T_min, T_opt)
+    S = x[..., areas]
+    Ds = S * (grwth * x[..., su, None] - species_param(death, TYPES))
+    # the following code applies 2 checks
+    # (1) keep the area to zero if it has been
+    # articifically set to exactly zero
+    # (2) apply the minimum area if the area comes below the threshold
+    x[..., areas] = np.where(S > 0, np.maximum(S + Ds, minarea), S)
 
     # update barren area (that what is left)
-    x["Su"] = 1 - x["Sw"] - x["Sb"]
+    x[..., su] = 1 - x[..., areas].sum(axis=-1)
 
 
-def NextState(x, F, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt):
-    # make a copy of the previous statevector to work on
-    xnew = x.copy()
+def NextState(
+    x, F, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt, out=None
+):
+    # work on a copy of the previous statevector, or write the new state
+    # directly into a preallocated row when out is given
+    if out is None:
+        xnew = x.copy()
+    else:
+        xnew = out
+        xnew[:] = x
+    stats = current_stats()
+    if stats is not None:
+        stats.nextstate += 1
     UpdateTemp(xnew, F, rat, em_p, sig, ins_p, Albedo)
     UpdateAreas(xnew, death, minarea, T_min, T_opt)
     UpdateAlbedo(xnew, Albedo)
     return xnew
 
 
+def species_number(Albedo):
+    # number of daisy species of a run with the albedos Albedo
+    if "daisies" in Albedo:
+        return np.shape(Albedo["daisies"])[-1]
+    return len(TYPES)
+
+
+def species_floats(p, n):
+    # a per species parameter of n species as a list of floats
+    if isinstance(p, dict) and "daisies" not in p:
+        values = [p[t] for t in TYPES]
+        if all(np.ndim(v) == 0 for v in values):
+            return [float(v) for v in values]
+    values = species_param(p, TYPES)
+    if values.shape != (n,):
+        values = np.broadcast_to(values, n)
+    return values.tolist()
+
+
+def species_table(Albedo, death, T_min, T_opt):
+    # the species parameters of a run as lists of floats, one entry per
+    # species: albedo, death rate, T_min and T_opt, and the albedo of the
+    # bare ground. Looked up once per run rather than on every step.
+    n = species_number(Albedo)
+    return (
+        float(Albedo["none"]),
+        species_floats(Albedo, n),
+        species_floats(death, n),
+        species_floats(T_min, n),
+        species_floats(T_opt, n),
+    )
+
+
+# A single run steps one small state vector thousands of times, where the
+# numpy call overhead of the array kernels above dominates. Its steps are
+# therefore taken on the state held as a list of floats (the columns of the
+# state vector), and the states are written into the preallocated arrays.
+# state_kernels works out the species parameters and the layout once per
+# run and returns
+#   start(S, F): the state with the daisy areas S, its albedo and its
+#                temperatures at the flux F (new_species_state, UpdateAlbedo
+#                and UpdateTemp)
+#   step(s, F):  one generation (NextState) at the flux F
+#   rates(S, F): the rate of change of the areas S per generation, the
+#                area update of NextState read as dS/dt (see
+#                update_constant_flux_ode)
+# evaluated in the same order as the array kernels. A float step costs
+# about 0.6 us per species and an array step about 40 us plus 0.2 us per
+# species, so runs of more than FLOAT_SPECIES species are stepped by the
+# array kernels instead (see array_state_kernels).
+FLOAT_SPECIES = 80
+
+
+def state_kernels(rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt):
+    anone, alb, gam, tmin, topt = species_table(Albedo, death, T_min, T_opt)
+    n = len(alb)
+    if n > FLOAT_SPECIES:
+        return array_state_kernels(
+            rat, em_p, sig, ins_p, anone, alb, gam, minarea, tmin, topt
+        )
+    species = list(zip(alb, gam, tmin, topt))
+    sqrt = math.sqrt
+
+    def start(S, F):
+        S = [float(Si) for Si in S]
+        Su = 1 - sum(S)
+        Ap = anone * Su + sum([a * Si for a, Si in zip(alb, S)])
+        Fp = F * (1 - Ap) * rat / em_p
+        T = [
+            sqrt(sqrt((ins_p * (F * (1 - a) * rat / em_p - Fp) + Fp) / sig))
+            for a in alb
+        ]
+        return S + [Su, Ap, sqrt(sqrt(Fp / sig))] + T + [CONVERGED]
+
+    def step(s, F):
+        # UpdateTemp, with the planetary albedo of the previous generation
+        Fp = F * (1 - s[n + 1]) * rat / em_p
+        Su = s[n]
+        S = []
+        T = []
+        total = 0
+        Ap = 0
+        for (a, g, lo, opt), Si in zip(species, s):
+            Ti = sqrt(sqrt((ins_p * (F * (1 - a) * rat / em_p - Fp) + Fp) / sig))
+            T.append(Ti)
+            # UpdateAreas: areas that are exactly zero stay zero, the
+            # others keep at least the minimum area
+            if Si > 0:
+                Si = Si + Si * (growth_rate(Ti, lo, opt) * Su - g)
+                if Si < minarea:
+                    Si = minarea
+            S.append(Si)
+            total += Si
+            Ap += a * Si
+        # UpdateAlbedo, with the new barren area
+        Su = 1 - total
+        S += [Su, anone * Su + Ap, sqrt(sqrt(Fp / sig))]
+        S += T
+        S.append(s[-1])
+        return S
+
+    def rates(S, F):
+        Su = 1 - sum(S)
+        Ap = anone * Su + sum([a * Si for a, Si in zip(alb, S)])
+        Fp = F * (1 - Ap) * rat / em_p
+        dS = []
+        for (a, g, lo, opt), Si in zip(species, S):
+            Ti = sqrt(sqrt((ins_p * (F * (1 - a) * rat / em_p - Fp) + Fp) / sig))
+            dS.append(Si * (growth_rate(Ti, lo, opt) * Su - g))
+        return dS
+
+    return start, step, rates
+
+
+def array_state_kernels(rat, em_p, sig, ins_p, anone, alb, gam, minarea, tmin, topt):
+    # start, step and rates of state_kernels for the species table of
+    # species_table, evaluated with the array kernels on all species at
+    # once (the states are still passed in and out as lists)
+    Albedo = {"none": anone, "daisies": np.array(alb)}
+    death = np.array(gam)
+    T_min = np.array(tmin)
+    T_opt = np.array(topt)
+
+    def start(S, F):
+        x = new_species_state(S)
+        UpdateAlbedo(x, Albedo)
+        UpdateTemp(x, F, rat, em_p, sig, ins_p, Albedo)
+        return x.tolist()
+
+    def step(s, F):
+        # NextState, without counting the call (the solvers count their
+        # steps themselves)
+        x = np.array(s)
+        UpdateTemp(x, F, rat, em_p, sig, ins_p, Albedo)
+        UpdateAreas(x, death, minarea, T_min, T_opt)
+        UpdateAlbedo(x, Albedo)
+        return x.tolist()
+
+    def rates(S, F):
+        x = np.array(start(S, F))
+        areas, su, _, _, temps, _ = species_layout(len(S))
+        grwth = DaisyGrowth(x[temps], TYPES, T_min, T_opt)
+        return (x[areas] * (grwth * x[su] - death)).tolist()
+
+    return start, step, rates
+
+
 # To aid this exercise write and additional function which updates
-# the state vector until  no noticable change in temperature is happening
-def Equi_state(x0, F, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt):
+# the state vector until  no noticable change in temperature is happening.
+# Extreme parameters (e.g. very bright white daisies with a high insulation)
+# make the iteration flip between states forever, so we also stop when the
+# temperature repeats with a period of up to maxperiod generations without
+# the cycle dying down, returning the average over one period, or after
+# maxiter generations. An oscillation that decays is followed until it
+# converges. The outcome is recorded in x[..., ST].
+def Equi_state(
+    x0,
+    F,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    Albedo,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    out=None,
+    maxiter=EQUI_MAXITER,
+    maxperiod=EQUI_MAXPERIOD,
+):
+    step = state_kernels(rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)[1]
+    s = equilibrium_state(step, x0.tolist(), F, maxiter, maxperiod)
+    if out is None:
+        return np.array(s)
+    out[:] = s
+    return out
+
+
+def equilibrium_state(step, s, F, maxiter=EQUI_MAXITER, maxperiod=EQUI_MAXPERIOD):
+    # Equi_state for a state held as a list and the step of its run (see
+    # state_kernels), returning the new list
+    s, niter, status = fixed_point(step, s, F, 0, [], maxiter, maxperiod)
+    s[-1] = status
+    stats = current_stats()
+    if stats is not None:
+        stats.nextstate += niter
+        _record_solve(niter, status)
+    return s
+
+
+def fixed_point(step, s, F, niter, hist, maxiter, maxperiod):
+    # the iteration of equilibrium_state, continued from the state s after
+    # niter steps, the last of which (at most 2 * maxperiod, oldest first)
+    # are the states in hist. Returns the final state, the number of steps
+    # and the status.
+    tp = (len(s) - 4) // 2 + 2
+    nhist = 2 * maxperiod
     dT = 2
-    x = x0.copy()
-    temp = x["Tp"]
+    temp = s[tp]
+    status = CONVERGED
     while dT > 0.05:
-        x = NextState(x, F, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)
-        dT = abs(temp - x["Tp"])
-        temp = x["Tp"]
-    return x
+        if niter >= maxiter:
+            status = MAXITER
+            break
+        s = step(s, F)
+        niter += 1
+        dT = abs(temp - s[tp])
+        temp = s[tp]
 
+        hist.append(s)
+        if len(hist) > nhist:
+            del hist[0]
+        # look for a cycle every maxperiod steps once the history is full,
+        # and only in a state that has not converged
+        if dT > 0.05 and niter % maxperiod == 0 and len(hist) == nhist:
+            period = _find_period([h[tp] for h in hist], maxperiod)
+            if period:
+                s = [sum(column) / period for column in zip(*hist[-period:])]
+                status = OSCILLATING
+                break
+    return s, niter, status
 
-def update_equi_flux(
-    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
-):
-    # Experiment 2 Planet response to varying solar flux
 
-    # set up variation of solar radiation
+def _find_period(temps, maxperiod, tol=0.05):
+    # the period (> 1) with which the last planetary temperatures temps
+    # repeat, or 0 if they do not form a cycle
+    last = temps[-1]
+    for period in range(2, min(maxperiod, len(temps) // 2) + 1):
+        if (
+            abs(last - temps[-1 - period]) < tol
+            and all(
+                abs(temps[-j] - temps[-j - period]) < tol for j in range(2, period + 1)
+            )
+            and not _cycle_decays(
+                max(temps[-period:]) - min(temps[-period:]),
+                max(temps[-2 * period : -period]) - min(temps[-2 * period : -period]),
+            )
+        ):
+            return period
+    return 0
+
+
+def _cycle_decays(swing, previous):
+    # whether the swing (max - min) of the temperatures over the last period
+    # has shrunk against the swing over the period before. The swing of a
+    # stable cycle stays the same, while a damped oscillation around an
+    # equilibrium (which repeats within the tolerance once its swing is
+    # small) loses a fixed fraction per period. Oscillations that lose less
+    # than CYCLE_DECAY of their swing per period would not settle within
+    # EQUI_MAXITER anyway.
+    return swing < (1 - CYCLE_DECAY) * previous
+
+
+def solar_flux_fractions():
+    # fractions of the nominal solar flux used in experiment 2
     nt = 200
     # amount of steps
     Fracmin = 0.6
     Fracmax = 1.65
     dF = (Fracmax - Fracmin) / nt
-    F = [dF * i + Fracmin for i in range(nt)]
+    return dF * np.arange(nt) + Fracmin
 
-    # set up initial condition
-    # initial condition state vector
-    x0 = {}
-    x0["Sw"] = 0.01
-    x0["Sb"] = 0.01
-    # compute barren area automatically
-    x0["Su"] = 1 - x0["Sw"] - x0["Sb"]
 
-    # note that we also need to initiate the planetary Albedo
-    UpdateAlbedo(x0, Albedo)
-    # and the temperature
-    UpdateTemp(x0, F[0] * Fsnom, rat, em_p, sig, ins_p, Albedo)
+def equi_sweep(
+    x0, F, Fsnom, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt
+):
+    # One sweep of experiment 2: starting from x0 (at F[0]), solve for the
+    # equilibrium at each following flux fraction, warm-started from the
+    # previous one. The states are written row by row into a preallocated array.
+    step = state_kernels(rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)[1]
+    xs = np.empty((len(F), x0.shape[-1]))
+    xs[0] = x0
+    s = xs[0].tolist()
+    for i in range(1, len(F)):
+        s = equilibrium_state(step, s, F[i] * Fsnom)
+        xs[i] = s
+    return xs
+
+
+# The barren planet sweep of update_equi_flux is independent of the forward
+# and backward sweeps, which take about four fifths of the time (the
+# backward sweep starts from the end of the forward one, so those two form
+# a chain). With parallel_sweeps switched on, the chain runs in a small
+# process pool while this process does the barren sweep. The pool is
+# created on first use and reused by every later call of the same
+# (gunicorn worker) process.
+parallel_sweeps = False
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def sweep_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=1)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def hysteresis_sweeps(
+    x0, F, Fsnom, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt
+):
+    # the forward sweep of experiment 2 from x0, and the backward sweep
+    # started from its end value (returned on the flux fractions F)
+    params = (rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)
+    with phase("forward_sweep"):
+        xeq = equi_sweep(x0, F, Fsnom, *params)
+
+    # also run the  experiment backwards
+    # (use the end value of the forward run as starting point)
+    Finv = np.concatenate([F[-1:], F[::-1]])
+    with phase("backward_sweep"):
+        xeqinv = equi_sweep(xeq[-1], Finv, Fsnom, *params)
+    # reverse the vector
+    return xeq, xeqinv[::-1][1:]
+
+
+def update_equi_flux(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    solver="fixed_point",
+):
+    # Experiment 2 Planet response to varying solar flux
+
+    # adaptive continuation takes its own flux steps
+    if solver == "adaptive":
+        return update_equi_flux_adaptive(
+            Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+        )
+    elif solver != "fixed_point":
+        raise ValueError("unknown solver: " + str(solver))
+    params = (rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)
+
+    # set up variation of solar radiation
+    F = solar_flux_fractions()
+
+    # set up initial condition, the same area for every daisy species
+    # (note that we also need to initiate the planetary Albedo and the
+    # temperature)
+    start = state_kernels(*params)[0]
+    n = species_number(Albedo)
+    x0 = np.array(start([0.01] * n, F[0] * Fsnom))
 
     # initial condition for a barren planet
-    x0bar = {}
-    x0bar["Sw"] = 0
-    x0bar["Sb"] = 0
-    x0bar["Su"] = 1
-    # note that we also need to set the planetary Albedo
-    UpdateAlbedo(x0bar, Albedo)
-    # and the temperature
-    UpdateTemp(x0bar, F[0] * Fsnom, rat, em_p, sig, ins_p, Albedo)
+    x0bar = np.array(start([0.0] * n, F[0] * Fsnom))
 
     # loop over radiation variation
-    xeq = []
-    xeq.append(x0)
-    xeqbar = []
-    xeqbar.append(x0bar)
-
-    for Fr in F[1:]:
-        xeq.append(
-            Equi_state(
-                xeq[-1],
-                Fr * Fsnom,
-                rat,
-                em_p,
-                sig,
-                ins_p,
-                Albedo,
-                death,
-                minarea,
-                T_min,
-                T_opt,
-            )
+    # (the solves of the sweeps in the pool are not counted, their phase
+    # is the time spent waiting for them)
+    if parallel_sweeps:
+        chain = sweep_pool().submit(hysteresis_sweeps, x0, F, Fsnom, *params)
+    with phase("barren_sweep"):
+        xeqbar = equi_sweep(x0bar, F, Fsnom, *params)
+    if parallel_sweeps:
+        with phase("hysteresis_sweeps"):
+            xeq, xeqinv = chain.result()
+    else:
+        xeq, xeqinv = hysteresis_sweeps(x0, F, Fsnom, *params)
+
+    return (xeq, xeqbar, xeqinv, F)
+
+
+# Follow one equilibrium branch over the flux fractions F, starting from x0
+# at F[0]. Steps of up to kmax grid points are taken where the equilibrium
+# changes slowly; a step is halved (down to a single grid point) whenever
+# the planetary temperature changes by more than dTmax or an area by more
+# than dSmax, which refines the sweep around the tipping points. Each solve
+# is warm-started from the previous equilibrium and the grid points that
+# were skipped are filled in by linear interpolation.
+# The fixed point iteration stops on the temperature alone, so an area near
+# minarea can still be creeping when it does and the next equilibrium then
+# depends on how many solves came before. Only settled states (converged,
+# with no area moving by settle in one more step) are therefore taken with a
+# coarse step, and the sweep goes one grid point at a time while they are
+# not, like the fixed sweep. This is still an approximation of the fixed
+# sweep: the tipping points agree and the temperatures agree to a fraction
+# of a kelvin away from them (see test_equilibrium.py).
+# Returns the states on every entry of F and the number of solves.
+def continuation_sweep(
+    x0,
+    F,
+    Fsnom,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    Albedo,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    kmax=32,
+    dTmax=3.0,
+    dSmax=0.05,
+    settle=1e-4,
+):
+    nt = len(F)
+    areas, _, _, tp, _, st = species_layout(species_count(x0))
+    step = state_kernels(rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)[1]
+    xs = np.empty((nt, x0.shape[-1]))
+    xs[0] = x0
+    nodes = [0]
+    nsolve = 0
+    i = 0
+    k = 1
+    while i < nt - 1:
+        k = min(k, nt - 1 - i)
+        Fk = F[i + k] * Fsnom
+        snew = equilibrium_state(step, xs[i].tolist(), Fk)
+        xnew = np.array(snew)
+        nsolve += 1
+        change = max(
+            abs(xnew[tp] - xs[i, tp]) / dTmax,
+            np.abs(xnew[areas] - xs[i, areas]).max() / dSmax,
+        )
+        settled = (
+            xnew[st] == CONVERGED
+            and np.abs(np.array(step(snew, Fk))[areas] - xnew[areas]).max() < settle
+        )
+        if k > 1 and (change > 1 or not settled):
+            # too coarse, refine
+            k //= 2
+            continue
+        xs[i + k] = xnew
+        nodes.append(i + k)
+        i += k
+        if not settled:
+            k = 1
+        elif change < 0.25:
+            k = min(2 * k, kmax)
+
+    # fill in the grid points between the solves
+    grid = np.arange(nt)
+    for c in range(st):
+        xs[:, c] = np.interp(grid, nodes, xs[nodes, c])
+    # the status is carried forward from the previous solve
+    xs[:, st] = xs[nodes, st][np.searchsorted(nodes, grid, side="right") - 1]
+    return xs, nsolve
+
+
+def update_equi_flux_adaptive(
+    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+):
+    # Experiment 2 with adaptive continuation instead of solving an
+    # equilibrium at every flux step. Returns the same (xeq, xeqbar, xeqinv, F)
+    # as update_equi_flux, on the same flux steps as hysteresis_sweeps.
+    F = solar_flux_fractions()
+    params = (rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)
+
+    # initial conditions with daisies (the same area for every species)
+    # and for a barren planet
+    start = state_kernels(*params)[0]
+    n = species_number(Albedo)
+    x0 = np.array(start([0.01] * n, F[0] * Fsnom))
+    x0bar = np.array(start([0.0] * n, F[0] * Fsnom))
+
+    with phase("forward_sweep"):
+        xeq, _ = continuation_sweep(x0, F, Fsnom, *params)
+    with phase("barren_sweep"):
+        xeqbar, _ = continuation_sweep(x0bar, F, Fsnom, *params)
+    # also run the experiment backwards from the end of the forward run, on
+    # the same flux fractions as hysteresis_sweeps
+    Finv = np.concatenate([F[-1:], F[::-1]])
+    with phase("backward_sweep"):
+        xeqinv, _ = continuation_sweep(xeq[-1], Finv, Fsnom, *params)
+
+    return (xeq, xeqbar, xeqinv[::-1][1:], F)
+
+
+def daisy_covered(x, minarea):
+    # whether a state carries daisies beyond the minimum area that every
+    # surviving species keeps on an otherwise barren planet
+    areas = species_layout(species_count(x))[0]
+    S = x[..., areas]
+    return S.sum(axis=-1) > S.shape[-1] * minarea + 0.01
+
+
+# Locate the tipping points of experiment 2, the flux fractions at which the
+# daisies appear on or vanish from the planet while the flux increases.
+# xeq are the equilibria of the forward sweep of update_equi_flux at the
+# flux fractions F. Every change between a daisy-covered and a barren
+# equilibrium from F[i] to F[i + 1] brackets a tipping point, which is then
+# bisected down to a width of tol with the solver of the sweep, always
+# warm-starting from the equilibrium at the lower end of the bracket, so
+# that we stay on the branch the sweep follows and the tipping points fall
+# where the plotted sweep changes.
+# Returns the critical flux fractions, whether daisies appear (True) or
+# collapse (False) there, and the number of equilibria solved.
+def tipping_points(
+    xeq,
+    F,
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    tol=1e-4,
+):
+    step = state_kernels(rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)[1]
+    covered = daisy_covered(xeq, minarea)
+    Fcrit = []
+    appear = []
+    nsolve = 0
+    with phase("bisection"):
+        for i in np.flatnonzero(covered[1:] != covered[:-1]):
+            lo, hi = F[i], F[i + 1]
+            slo = xeq[i].tolist()
+            while hi - lo > tol:
+                mid = 0.5 * (lo + hi)
+                smid = equilibrium_state(step, slo, mid * Fsnom)
+                nsolve += 1
+                if daisy_covered(np.array(smid), minarea) == covered[i]:
+                    lo, slo = mid, smid
+                else:
+                    hi = mid
+            Fcrit.append(0.5 * (lo + hi))
+            appear.append(not covered[i])
+
+    return np.array(Fcrit), np.array(appear, dtype=bool), nsolve
+
+
+# Transient version of experiment 2: instead of a sequence of equilibria,
+# the luminosity ramps linearly from Fracmin to Fracmax times the nominal
+# flux over nsteps daisy generations and the areas evolve with NextState
+# all the way. The trajectory is produced chunk by chunk: after every nchunk
+# generations the states of the generations that are multiples of decimate
+# are yielded, as (generation numbers, flux fractions, states), so that no
+# caller ever holds the full trajectory.
+# One small state vector is stepped 10^5 times, with the float kernels of
+# state_kernels.
+def transient_flux_chunks(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    areas,
+    nsteps=100000,
+    Fracmin=0.6,
+    Fracmax=1.65,
+    nchunk=10000,
+    decimate=100,
+):
+    frac = np.linspace(Fracmin, Fracmax, nsteps)
+    flux = (frac * Fsnom).tolist()
+
+    # initial condition state vector
+    start, step, _ = state_kernels(
+        rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt
+    )
+    s = start(species_floats(areas, species_number(Albedo)), flux[0])
+    for first in range(0, nsteps, nchunk):
+        stop = min(first + nchunk, nsteps)
+        rows = []
+        with phase("transient"):
+            for g in range(first, stop):
+                if g > 0:
+                    s = step(s, flux[g])
+                if g % decimate == 0:
+                    rows.append(s)
+        gens = np.arange(first + (-first % decimate), stop, decimate)
+        yield gens, frac[gens], np.array(rows).reshape(len(gens), len(s))
+
+
+def transient_flux(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    areas,
+    nsteps=100000,
+    decimate=100,
+):
+    # the decimated transient trajectory, collected from its chunks
+    chunks = list(
+        transient_flux_chunks(
+            Fsnom,
+            Albedo,
+            rat,
+            em_p,
+            sig,
+            ins_p,
+            death,
+            minarea,
+            T_min,
+            T_opt,
+            areas,
+            nsteps=nsteps,
+            decimate=decimate,
+        )
+    )
+    gens = np.concatenate([c[0] for c in chunks])
+    frac = np.concatenate([c[1] for c in chunks])
+    xs = np.concatenate([c[2] for c in chunks])
+    return gens, frac, xs
+
+
+def _expand(p, nbatch):
+    # broadcast an array valued parameter to one value per batch member,
+    # scalar parameters are shared by all members and passed through
+    if isinstance(p, dict):
+        return {k: _expand(v, nbatch) for k, v in p.items()}
+    if np.ndim(p) == 0:
+        return p
+    return np.broadcast_to(np.asarray(p, dtype=float), (nbatch,))
+
+
+def _take(p, idx):
+    # select the batch members idx of an (expanded) parameter
+    if isinstance(p, dict):
+        return {k: _take(v, idx) for k, v in p.items()}
+    if np.ndim(p) == 0:
+        return p
+    return p[idx]
+
+
+def batch_size(*params):
+    # number of scenarios described by a set of (possibly dict valued)
+    # parameters, each of which is a scalar or a 1-d array
+    leaves = []
+    for p in params:
+        leaves.extend(p.values() if isinstance(p, dict) else [p])
+    shape = np.broadcast_shapes(*[np.shape(p) for p in leaves])
+    if len(shape) > 1:
+        raise ValueError("batched parameters must be scalars or 1-d arrays")
+    return shape[0] if shape else 1
+
+
+def _check_daisy_types(Albedo):
+    # the batch solvers batch over the scenarios of the two daisy types
+    if "daisies" in Albedo:
+        raise ValueError(
+            "the batch solvers take the two daisy types; run species arrays "
+            "one scenario at a time with update_equi_flux or "
+            "update_constant_flux"
+        )
+
+
+def batch_species(Albedo, death, T_min, T_opt, nbatch):
+    # the per species parameters of a batch (of the two daisy types) as
+    # arrays of shape (nbatch, 2), so that the kernels do not look them up
+    # again on every step. The batch members are selected with _take.
+    def table(p):
+        return np.broadcast_to(species_param(p, TYPES), (nbatch, len(TYPES)))
+
+    Albedo = {"none": Albedo["none"], "daisies": table(Albedo)}
+    return Albedo, table(death), table(T_min), table(T_opt)
+
+
+# Batched version of Equi_state: x0 has shape (nbatch, NVARS) and the
+# parameters are scalars or arrays of length nbatch. All members are
+# stepped together with the array kernels, with the same convergence and
+# cycle tests as Equi_state. A member that finishes is saved into the
+# result, and the finished members are dropped from the stepped arrays
+# once they make up half of them. When at most SCALAR_MEMBERS members are
+# left, which is cheaper on floats, each of them continues with the
+# iteration of Equi_state (see fixed_point) from where the batch left off.
+SCALAR_MEMBERS = 8
+# Every flux step of a sweep waits for the slowest member of the batch, so
+# the sweeps of update_equi_flux_batch only run on the array kernels from
+# ARRAY_BATCH scenarios on; smaller batches are faster on floats.
+ARRAY_BATCH = 64
+
+
+def Equi_state_batch(
+    x0,
+    F,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    Albedo,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    out=None,
+    maxiter=EQUI_MAXITER,
+    maxperiod=EQUI_MAXPERIOD,
+):
+    if out is None:
+        x = x0.copy()
+    else:
+        x = out
+        x[:] = x0
+    Albedo, death, T_min, T_opt = batch_species(Albedo, death, T_min, T_opt, len(x))
+    params = (F, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)
+    _, _, _, tp, _, st = species_layout(species_count(x))
+    x[:, st] = CONVERGED
+    # the members in the stepped array sub, and which of them are finished
+    active = np.arange(len(x))
+    sub = x.copy()
+    sub_params = params
+    done = np.zeros(len(x), dtype=bool)
+    # the last states of sub, for detecting cycles: a ring of 2 * maxperiod
+    # states, the latest at row niter % nhist
+    nhist = 2 * maxperiod
+    hist = np.empty((nhist,) + x.shape)
+    niter = 0
+    nleft = len(x)
+    while nleft > SCALAR_MEMBERS:
+        # members that never settle are cut off after maxiter steps
+        if niter >= maxiter:
+            x[active[~done]] = sub[~done]
+            x[active[~done], st] = MAXITER
+            done[:] = True
+            break
+        temp = sub[:, tp].copy()
+        NextState(sub, *sub_params, out=sub)
+        niter += 1
+        hist[niter % nhist] = sub
+        moving = abs(temp - sub[:, tp]) > 0.05
+
+        settled = ~moving & ~done
+        x[active[settled]] = sub[settled]
+        done |= settled
+        # look for cycles every maxperiod steps once the history is full
+        if niter >= nhist and niter % maxperiod == 0:
+            check = np.flatnonzero(moving & ~done)
+            # the temperatures of the last states, latest first
+            rows = [(niter - j) % nhist for j in range(nhist)]
+            T = hist[rows][:, check, tp]
+            # the shortest period with which the temperatures repeat (only
+            # the periods at which the latest one recurs are checked in full)
+            periods = np.arange(2, maxperiod + 1)
+            recurs = (np.abs(T[0] - T[periods]) < 0.05).any(axis=1)
+            period = np.zeros(check.size, dtype=int)
+            for p in periods[recurs]:
+                repeats = (np.abs(T[:p] - T[p : 2 * p]) < 0.05).all(axis=0)
+                swing = T[:p].max(axis=0) - T[:p].min(axis=0)
+                previous = T[p : 2 * p].max(axis=0) - T[p : 2 * p].min(axis=0)
+                repeats &= ~_cycle_decays(swing, previous)
+                period[(period == 0) & repeats] = p
+            for p in np.unique(period[period > 0]):
+                # average over one period, summed from the oldest state on
+                cycling = check[period == p]
+                x[active[cycling]] = hist[rows[p - 1 :: -1]][:, cycling].sum(axis=0) / p
+                x[active[cycling], st] = OSCILLATING
+                done[cycling] = True
+
+        nleft = active.size - np.count_nonzero(done)
+        if nleft and 2 * nleft <= active.size:
+            keep = ~done
+            active = active[keep]
+            sub = sub[keep]
+            hist = hist[:, keep]
+            sub_params = [_take(p, active) for p in params]
+            done = done[keep]
+
+    # the last few members continue on floats, with their history
+    rows = [(niter - j) % nhist for j in range(min(niter, nhist) - 1, -1, -1)]
+    nsteps = niter
+    for i in np.flatnonzero(~done):
+        step = _member_step(sub_params, i)
+        s, n, status = fixed_point(
+            step,
+            sub[i].tolist(),
+            _member(sub_params[0], i),
+            niter,
+            hist[rows, i].tolist(),
+            maxiter,
+            maxperiod,
         )
-        xeqbar.append(
-            Equi_state(
-                xeqbar[-1],
+        s[-1] = status
+        x[active[i]] = s
+        nsteps = max(nsteps, n)
+        stats = current_stats()
+        if stats is not None:
+            stats.nextstate += n - niter
+    _record_solve(nsteps, x[:, st])
+    return x
+
+
+def _member_step(params, i):
+    # the float step (see state_kernels) of the member i of a batch with the
+    # parameters (F, rat, ..., T_opt) of Equi_state_batch
+    _, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt = params
+    return state_kernels(
+        _member(rat, i),
+        _member(em_p, i),
+        _member(sig, i),
+        _member(ins_p, i),
+        {"none": _member(Albedo["none"], i), "daisies": Albedo["daisies"][i]},
+        death[i],
+        _member(minarea, i),
+        T_min[i],
+        T_opt[i],
+    )[1]
+
+
+def _member(p, i):
+    # the value of the member i of an (expanded) scalar parameter
+    return float(p) if np.ndim(p) == 0 else float(p[i])
+
+
+def update_equi_flux_batch(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    maxiter=EQUI_MAXITER,
+):
+    # Experiment 2 for many parameter combinations at once. Any of the
+    # parameters (or entries of the parameter dicts) can be a 1-d array with
+    # one value per scenario, e.g. 500 white/black albedo pairs. The returned
+    # states have shape (nt, nbatch, NVARS).
+    _check_daisy_types(Albedo)
+    nbatch = batch_size(
+        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+    )
+    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt = [
+        _expand(p, nbatch)
+        for p in (Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt)
+    ]
+    Albedo, death, T_min, T_opt = batch_species(Albedo, death, T_min, T_opt, nbatch)
+
+    # set up variation of solar radiation
+    F = solar_flux_fractions()
+    nt = len(F)
+
+    xeq = np.empty((nt, nbatch, NVARS))
+    xeqbar = np.empty((nt, nbatch, NVARS))
+
+    # set up initial condition (daisies and barren planet)
+    xeq[0] = new_state(0.01, 0.01)
+    xeqbar[0] = new_state(0, 0)
+    for x0 in (xeq[0], xeqbar[0]):
+        UpdateAlbedo(x0, Albedo)
+        UpdateTemp(x0, F[0] * Fsnom, rat, em_p, sig, ins_p, Albedo)
+
+    if nbatch > ARRAY_BATCH:
+
+        def solve(x, Fr, out):
+            Equi_state_batch(
+                x,
                 Fr * Fsnom,
                 rat,
                 em_p,
@@ -150,30 +1172,36 @@ def update_equi_flux(
                 minarea,
                 T_min,
                 T_opt,
+                out=out,
+                maxiter=maxiter,
             )
-        )
+
+    else:
+        # too few scenarios for the array kernels to pay off (see
+        # ARRAY_BATCH), solve each of them on floats like Equi_state_batch
+        # does with its last members
+        params = (None, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)
+        steps = [_member_step(params, k) for k in range(nbatch)]
+        fluxes = [_member(Fsnom, k) for k in range(nbatch)]
+
+        def solve(x, Fr, out):
+            for k, step in enumerate(steps):
+                out[k] = equilibrium_state(
+                    step, x[k].tolist(), float(Fr * fluxes[k]), maxiter
+                )
+
+    # loop over radiation variation
+    for i in range(1, nt):
+        for xs in (xeq, xeqbar):
+            solve(xs[i - 1], F[i], xs[i])
 
     # also run the  experiment backwards
     # (use the end value of the forward run as starting point)
-    xeqinv = []
-    xeqinv.append(xeq[-1])
+    xeqinv = np.empty((nt + 1, nbatch, NVARS))
+    xeqinv[0] = xeq[-1]
 
-    for Fr in F[::-1]:
-        xeqinv.append(
-            Equi_state(
-                xeqinv[-1],
-                Fr * Fsnom,
-                rat,
-                em_p,
-                sig,
-                ins_p,
-                Albedo,
-                death,
-                minarea,
-                T_min,
-                T_opt,
-            )
-        )
+    for i, Fr in enumerate(F[::-1]):
+        solve(xeqinv[i], Fr, xeqinv[i + 1])
 
     # reverse the vector
     xeqinv = xeqinv[::-1][1:]
@@ -182,48 +1210,426 @@ def update_equi_flux(
 
 
 def update_constant_flux(
-    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, areas
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    areas,
+    mode="discrete",
 ):
     # First experiment
+
+    # the continuous-time formulation has its own integrator
+    if mode == "continuous":
+        return update_constant_flux_ode(
+            Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, areas
+        )
+    elif mode != "discrete":
+        raise ValueError("unknown mode: " + str(mode))
+
     F = Fsnom * 1  # solar radiation
 
-    # initial condition state vector
-    x0 = {}
-    x0["Sw"] = areas["w"]
-    x0["Sb"] = areas["b"]
-    x0["Su"] = 1 - x0["Sw"] - x0["Sb"]
-    # note that we also need to initiate the planetary Albedo
-    UpdateAlbedo(x0, Albedo)
-    # and the temperature
-    UpdateTemp(x0, F, rat, em_p, sig, ins_p, Albedo)
+    # loop over generations
+    ngen = 40
+
+    # initial condition state vector (areas holds the initial area of
+    # every daisy species, keyed by type or as an array)
+    start, step, _ = state_kernels(
+        rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt
+    )
+    # note that we also need to initiate the planetary Albedo and the
+    # temperature
+    s = start(species_floats(areas, species_number(Albedo)), F)
+
+    # the generations are written row by row into a preallocated array
+    xgens = np.empty((ngen, len(s)))
+    xgens[0] = s
+    for g in range(1, ngen):
+        s = step(s, F)
+        xgens[g] = s
+    stats = current_stats()
+    if stats is not None:
+        stats.nextstate += ngen - 1
+
+    gens = np.arange(ngen)
+
+    return xgens, gens
+
+
+def update_constant_flux_batch(
+    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, areas
+):
+    # Experiment 1 for many parameter combinations at once (see
+    # update_equi_flux_batch). The returned states have shape
+    # (ngen, nbatch, NVARS).
+    _check_daisy_types(Albedo)
+    nbatch = batch_size(
+        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, areas
+    )
+    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, areas = [
+        _expand(p, nbatch)
+        for p in (
+            Fsnom,
+            Albedo,
+            rat,
+            em_p,
+            sig,
+            ins_p,
+            death,
+            minarea,
+            T_min,
+            T_opt,
+            areas,
+        )
+    ]
+    Albedo, death, T_min, T_opt = batch_species(Albedo, death, T_min, T_opt, nbatch)
+    F = Fsnom * 1  # solar radiation
 
     # loop over generations
     ngen = 40
 
-    xgens = []
-    xgens.append(x0)
+    xgens = np.zeros((ngen, nbatch, NVARS))
+
+    # initial condition state vector
+    xgens[0, :, SW] = areas["w"]
+    xgens[0, :, SB] = areas["b"]
+    xgens[0, :, SU] = 1 - xgens[0, :, SW] - xgens[0, :, SB]
+    UpdateAlbedo(xgens[0], Albedo)
+    UpdateTemp(xgens[0], F, rat, em_p, sig, ins_p, Albedo)
+
     for g in range(ngen - 1):
-        xgens.append(
-            NextState(
-                xgens[-1],
-                F,
-                rat,
-                em_p,
-                sig,
-                ins_p,
-                Albedo,
-                death,
-                minarea,
-                T_min,
-                T_opt,
-            )
+        NextState(
+            xgens[g],
+            F,
+            rat,
+            em_p,
+            sig,
+            ins_p,
+            Albedo,
+            death,
+            minarea,
+            T_min,
+            T_opt,
+            out=xgens[g + 1],
         )
 
-    gens = [i for i in range(ngen)]
+    gens = np.arange(ngen)
+
+    return xgens, gens
+
+
+# Dormand-Prince 5(4) coefficients for the adaptive integrator below
+_DP_C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1])
+_DP_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+# 5th order weights (the last stage of one step is the first of the next)
+_DP_B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0])
+# difference between the 5th and the embedded 4th order weights
+_DP_E = np.array(
+    [
+        71 / 57600,
+        0,
+        -71 / 16695,
+        71 / 1920,
+        -17253 / 339200,
+        22 / 525,
+        -1 / 40,
+    ]
+)
+# dense output: within a step from t to t + h,
+#   y(t + theta h) = y + h * k.T @ _DP_P @ [theta, theta^2, theta^3, theta^4]
+# (the free interpolant of Dormand and Prince, as used by scipy's RK45)
+_DP_P = np.array(
+    [
+        [
+            1,
+            -8048581381 / 2820520608,
+            8663915743 / 2820520608,
+            -12715105075 / 11282082432,
+        ],
+        [0, 0, 0, 0],
+        [
+            0,
+            131558114200 / 32700410799,
+            -68118460800 / 10900136933,
+            87487479700 / 32700410799,
+        ],
+        [
+            0,
+            -1754552775 / 470086768,
+            14199869525 / 1410260304,
+            -10690763975 / 1880347072,
+        ],
+        [
+            0,
+            127303824393 / 49829197408,
+            -318862633887 / 49829197408,
+            701980252875 / 199316789632,
+        ],
+        [0, -282668133 / 205662961, 2019193451 / 616988883, -1453857185 / 822651844],
+        [0, 40617522 / 29380423, -110615467 / 29380423, 69997945 / 29380423],
+    ]
+)
+
+
+def integrate_adaptive(
+    fun, y0, t_eval, rtol=1e-6, atol=1e-9, project=None, hmin_rel=1e-12
+):
+    # Integrate dy/dt = fun(y) with the Dormand-Prince 5(4) pair and an
+    # adaptive step size, returning y at the (increasing) times t_eval and
+    # the number of accepted steps. The steps are chosen by the error
+    # control alone; the outputs inside a step are interpolated with the
+    # dense output formula. project, if given, maps every accepted state
+    # (and every output) back onto the admissible states.
+    # A step whose error is not finite (e.g. fun overflowed) is rejected
+    # like any other, and a RuntimeError is raised when a rejected step
+    # would shrink below hmin_rel times the integration interval.
+    ys = np.empty((len(t_eval), len(y0)))
+    ys[0] = y0
+    t = t_eval[0]
+    t_end = t_eval[-1]
+    y = np.array(y0, dtype=float)
+    h = 0.1
+    hmin = hmin_rel * (t_end - t)
+    nstep = 0
+    k = np.empty((7, len(y0)))
+    k[0] = fun(y)
+    i = 1
+    while i < len(t_eval):
+        # do not step past the last output time
+        last = h >= t_end - t
+        if last:
+            h = t_end - t
+        for s in range(1, 7):
+            k[s] = fun(y + h * (np.dot(_DP_A[s], k[:s])))
+        ynew = y + h * (_DP_B @ k)
+        err = h * (_DP_E @ k)
+        scale = atol + rtol * np.maximum(np.abs(y), np.abs(ynew))
+        errnorm = np.sqrt(np.mean((err / scale) ** 2))
+        if errnorm <= 1:
+            tnew = t_end if last else t + h
+            # the outputs within the step, all at once
+            j = np.searchsorted(t_eval, tnew, side="right")
+            if j > i:
+                theta = (t_eval[i:j, None] - t) / h
+                yi = y + h * (theta ** np.arange(1, 5) @ _DP_P.T @ k)
+                ys[i:j] = yi if project is None else project(yi)
+                i = j
+            t = tnew
+            if project is None:
+                y = ynew
+                k[0] = k[6]
+            else:
+                y = project(ynew)
+                # the last stage is the first of the next step, unless
+                # the projection moved the state
+                k[0] = k[6] if np.array_equal(y, ynew) else fun(y)
+            nstep += 1
+        elif not np.isfinite(errnorm):
+            # a nan error fails the test above as well, reject the step
+            # with the largest reduction
+            errnorm = np.inf
+        # standard step size control with a safety factor
+        h *= min(5, max(0.2, 0.9 * errnorm ** -0.2 if errnorm > 0 else 5))
+        if errnorm > 1 and h < hmin:
+            raise RuntimeError(
+                "integrate_adaptive: step size %g below the minimum %g at t = %g"
+                % (h, hmin, t)
+            )
+    return ys, nstep
+
+
+def update_constant_flux_ode(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    areas,
+    ngen=40,
+    rtol=1e-6,
+):
+    # Continuous-time version of the first experiment: the area update of
+    # UpdateAreas read as a rate per generation,
+    #   dS/dt = S * (growth(T) * Su - death),
+    # integrated with an adaptive step size. Returns the states at the
+    # generations 0 .. ngen - 1 like update_constant_flux.
+    F = Fsnom * 1  # solar radiation
+    dSdt = state_kernels(rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt)[2]
+
+    def rates(S):
+        return np.array(dSdt(S.tolist(), F))
+
+    def project(S):
+        # as in UpdateAreas: extinct daisies stay extinct, the others keep
+        # at least the minimum area
+        return np.where(S > 0, np.maximum(S, minarea), 0)
+
+    gens = np.arange(ngen)
+    S0 = np.array(species_floats(areas, species_number(Albedo)))
+    S, _ = integrate_adaptive(rates, S0, gens, rtol=rtol, project=project)
+
+    # full state vectors at the output generations
+    xgens = new_species_state(S)
+    UpdateAlbedo(xgens, Albedo)
+    UpdateTemp(xgens, F, rat, em_p, sig, ins_p, Albedo)
 
     return xgens, gens
 
 
+# Spatial Daisyworld: the planet is an (nlat, nlon) grid of cells, each with
+# its own daisy areas, albedo and temperatures stored in the usual state
+# vector layout, i.e. a state array of shape (nlat, nlon, NVARS) that the
+# kernels above update in place. Cells receive insolation depending on their
+# latitude, exchange heat with their neighbours by diffusion and seed their
+# neighbours with daisies. All updates are whole-array stencils.
+
+
+def grid_latitudes(nlat):
+    # latitudes (in radians) of the cell centres, south to north
+    return (np.arange(nlat) + 0.5) / nlat * np.pi - np.pi / 2
+
+
+def insolation_factor(lat, s2=-0.482):
+    # annual mean insolation relative to the global mean (second Legendre
+    # polynomial fit, North 1975), the global mean of the factor is 1
+    return 1 + s2 * (3 * np.sin(lat) ** 2 - 1) / 2
+
+
+def _neighbour_mean(a):
+    # mean over the four neighbours of every cell of a (nlat, nlon, ...)
+    # field: periodic in longitude, the poles reflect
+    ap = np.concatenate([a[:1], a, a[-1:]], axis=0)
+    return 0.25 * (ap[:-2] + ap[2:] + np.roll(a, 1, axis=1) + np.roll(a, -1, axis=1))
+
+
+def UpdateGridTemp(x, F, rat, em_p, sig, ins_p, Albedo, diff, ndiff=4):
+    # local radiative equilibrium temperature of every cell (F holds the
+    # flux per latitude, broadcast along the rows)
+    UpdateTemp(x, F, rat, em_p, sig, ins_p, Albedo)
+
+    # diffuse heat between neighbouring cells, diff is the fraction
+    # exchanged with the neighbours per diffusion step (at most 1)
+    Tp = x[..., TP]
+    for _ in range(ndiff):
+        Tp += diff * (_neighbour_mean(Tp) - Tp)
+
+    # the daisy regions see the flux of the diffused planetary temperature
+    UpdateDaisyTemp(x, F, rat, em_p, sig, ins_p, Albedo, sig * Tp ** 4)
+    return x
+
+
+def UpdateGridAreas(x, death, minarea, T_min, T_opt, seed):
+    # as UpdateAreas, but a fraction seed of the new growth of a cell comes
+    # from the daisies of the neighbouring cells
+    grwth = DaisyGrowth(x[..., TEMPS], TYPES, T_min, T_opt)
+    S = x[..., AREAS]
+    Sseed = (1 - seed) * S + seed * _neighbour_mean(S)
+    Ds = Sseed * grwth * x[..., SU, None] - S * species_param(death, TYPES)
+    # daisy types that are set to exactly zero everywhere stay extinct, the
+    # others keep at least the minimum area in every cell
+    alive = S.any(axis=(0, 1))
+    Snew = np.where(alive, np.maximum(S + Ds, minarea), 0)
+    # the daisies cannot cover more than the cell
+    x[..., AREAS] = Snew / np.maximum(Snew.sum(axis=-1, keepdims=True), 1)
+    x[..., SU] = 1 - x[..., SW] - x[..., SB]
+
+
+def NextGridState(
+    x, F, rat, em_p, sig, ins_p, Albedo, death, minarea, T_min, T_opt, diff, seed
+):
+    # one generation of the spatial model, in place
+    UpdateGridTemp(x, F, rat, em_p, sig, ins_p, Albedo, diff)
+    UpdateGridAreas(x, death, minarea, T_min, T_opt, seed)
+    UpdateAlbedo(x, Albedo)
+    return x
+
+
+def update_grid_flux(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    areas,
+    nlat=256,
+    nlon=256,
+    ngen=40,
+    diff=0.2,
+    seed=0.2,
+    noise=0.5,
+    rng_seed=0,
+):
+    # Spatial version of the first experiment. The initial areas are
+    # perturbed by a relative random noise so that patterns can form.
+    # Returns the final grid state, the area weighted global mean state of
+    # every generation and the cell latitudes.
+    if "daisies" in Albedo:
+        raise ValueError("the grid model takes the two daisy types")
+    lat = grid_latitudes(nlat)
+    F = Fsnom * insolation_factor(lat)[:, None]  # solar radiation per row
+    weights = np.cos(lat) / np.cos(lat).sum()
+
+    rng = np.random.default_rng(rng_seed)
+    # the variables are stored plane by plane so that every x[..., IDX] of
+    # the (nlat, nlon, NVARS) view is a contiguous field
+    x = np.moveaxis(np.zeros((NVARS, nlat, nlon)), 0, -1)
+    for i, t in enumerate(TYPES):
+        x[..., SW + i] = areas[t] * (1 + noise * rng.uniform(-1, 1, (nlat, nlon)))
+    x[..., SU] = 1 - x[..., SW] - x[..., SB]
+    UpdateAlbedo(x, Albedo)
+    UpdateGridTemp(x, F, rat, em_p, sig, ins_p, Albedo, diff)
+
+    xmean = np.empty((ngen, NVARS))
+    xmean[0] = weights @ x.mean(axis=1)
+    for g in range(1, ngen):
+        NextGridState(
+            x,
+            F,
+            rat,
+            em_p,
+            sig,
+            ins_p,
+            Albedo,
+            death,
+            minarea,
+            T_min,
+            T_opt,
+            diff,
+            seed,
+        )
+        xmean[g] = weights @ x.mean(axis=1)
+    # the temperatures that go with the final areas
+    UpdateGridTemp(x, F, rat, em_p, sig, ins_p, Albedo, diff)
+    x[..., ST] = CONVERGED
+    xmean[:, ST] = CONVERGED
+
+    return x, xmean, lat
+
+
 def update_solar_constant(solar_distance):
     luminosity = 10e26
     # nominal flux in W/m^2
@@ -237,3 +1643,90 @@ def toAU(distance):
 
 def fromAU(distance):
     return distance * 1.496e11
+
+
+def _canonical(p):
+    # json fallback for numpy scalars and arrays in the parameter dicts
+    if isinstance(p, np.ndarray):
+        return p.tolist()
+    return float(p)
+
+
+def params_key(**params):
+    # canonical hash of a parameter dict (independent of key order)
+    s = json.dumps(params, sort_keys=True, default=_canonical)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def _freeze(result):
+    # mark cached arrays read-only, as they are shared between callers
+    if isinstance(result, np.ndarray):
+        result.setflags(write=False)
+    elif isinstance(result, tuple):
+        for r in result:
+            _freeze(r)
+    return result
+
+
+# Memoizes model runs so that both figures of a tab (and repeated slider
+# positions) reuse one simulation. Entries are keyed on the function name
+# and a canonical hash of the parameters, and the least recently used entry
+# is evicted once maxsize runs are stored.
+class SimulationCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        # optional precomputed lattice (see lattice.py) consulted on a miss
+        self.lattice = None
+        self.hits = 0
+        self.misses = 0
+        self._runs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, func, **params):
+        key = (func.__name__, params_key(**params))
+        stats = current_stats()
+        with self._lock:
+            if key in self._runs:
+                self.hits += 1
+                self._runs.move_to_end(key)
+                if stats is not None:
+                    stats.cache["hits"] += 1
+                return self._runs[key]
+            self.misses += 1
+        # run the model outside of the lock, so other threads are not blocked
+        result = None
+        with phase(func.__name__):
+            if self.lattice is not None:
+                result = self.lattice.lookup(func, **params)
+            source = "lattice"
+            if result is None:
+                result = func(**params)
+                source = "computed"
+        if stats is not None:
+            stats.cache[source] += 1
+        result = _freeze(result)
+        with self._lock:
+            self._runs[key] = result
+            self._runs.move_to_end(key)
+            while len(self._runs) > self.maxsize:
+                self._runs.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._runs),
+                "maxsize": self.maxsize,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._runs.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# shared by all figure builders of this process
+simulation_cache = SimulationCache()
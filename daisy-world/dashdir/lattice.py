@@ -0,0 +1,157 @@
+# file lattice.py
+
+# Precomputes the varying flux experiment of tab 2 over the full lattice of
+# its slider positions and stores the sweeps in a memory-mapped .npy file
+# (about 1 GB). All gunicorn workers map the same pages, so callbacks on the
+# lattice are answered without running the model. The constant flux runs of
+# tab 1 take well under a millisecond and are not stored: with the distance
+# slider their lattice would be about 3 GB. Build it offline with:
+#
+#     python lattice.py [outdir]
+#
+# Parameters that have no slider are taken from init_vars.json; the lattice
+# is only used while they keep these values.
+
+import json
+import os
+import sys
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import calculations as calc
+
+DEFAULT_DIR = "lattice"
+
+
+def _steps(start, stop, step):
+    # slider positions, rounded like the values the dcc.Slider sends
+    n = int(round((stop - start) / step)) + 1
+    return np.round(start + step * np.arange(n), 10)
+
+
+# slider positions of tab 2 (see the dcc.Slider definitions in app.py)
+SLIDERS = {
+    "Aw": _steps(0.5, 1, 0.05),
+    "Ab": _steps(0, 0.5, 0.05),
+    "Ap": _steps(0.3, 0.7, 0.01),
+    "ins": _steps(0, 0.5, 0.05),
+}
+
+# lattice axes of the stored experiments
+AXES = {
+    "update_equi_flux": ["Aw", "Ab", "Ap", "ins"],
+}
+
+
+def fixed_params(params):
+    # the parameters which are not set by the sliders
+    fixed = dict(params)
+    fixed["Albedo"] = {}
+    for k in ["Fsnom", "ins_p", "areas", "solver", "mode"]:
+        fixed.pop(k, None)
+    return fixed
+
+
+def _slider_params(values, init_vars):
+    # parameter dict for arrays of slider values (one entry per lattice point)
+    params = dict(init_vars)
+    params["Albedo"] = {"none": values[2], "w": values[0], "b": values[1]}
+    params["ins_p"] = values[3]
+    return params
+
+
+def build(outdir, init_vars, names=None):
+    # run the experiments for all slider positions, one (Aw, Ab) block of
+    # the lattice at a time, writing straight into the memory-mapped files
+    os.makedirs(outdir, exist_ok=True)
+    for name in names or AXES:
+        axes = AXES[name]
+        shape = tuple(len(SLIDERS[a]) for a in axes)
+        inner = shape[2:]
+        # (xeq, xeqbar, xeqinv) x (nt, NVARS) per lattice point
+        tail = (3, len(calc.solar_flux_fractions()), calc.NVARS)
+        out = open_memmap(
+            os.path.join(outdir, name + ".npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=shape + tail,
+        )
+        rest = [
+            g.ravel()
+            for g in np.meshgrid(*[SLIDERS[a] for a in axes[2:]], indexing="ij")
+        ]
+        for i, Aw in enumerate(SLIDERS["Aw"]):
+            for j, Ab in enumerate(SLIDERS["Ab"]):
+                values = [Aw, Ab] + rest
+                params = _slider_params(values, init_vars)
+                xeq, xeqbar, xeqinv, _ = calc.update_equi_flux_batch(**params)
+                block = np.moveaxis(np.stack([xeq, xeqbar, xeqinv]), 2, 0)
+                out[i, j] = block.reshape(inner + tail)
+            print(name, "Aw =", Aw, "done")
+        out.flush()
+        del out
+
+    meta = {"fixed": calc.params_key(**fixed_params(init_vars))}
+    with open(os.path.join(outdir, "meta.json"), "w") as outfile:
+        json.dump(meta, outfile)
+
+
+def _index(values, v):
+    # position of v on a slider, or None for off-lattice values
+    idx = np.flatnonzero(np.isclose(values, v, rtol=1e-9, atol=1e-9))
+    if len(idx) == 0:
+        return None
+    return idx[0]
+
+
+class Lattice:
+    # read-only view of a built lattice directory
+    def __init__(self, outdir=DEFAULT_DIR):
+        with open(os.path.join(outdir, "meta.json")) as infile:
+            meta = json.load(infile)
+        self.fixed = meta["fixed"]
+        self.runs = {}
+        for name in AXES:
+            path = os.path.join(outdir, name + ".npy")
+            if os.path.exists(path):
+                self.runs[name] = np.load(path, mmap_mode="r")
+
+    def lookup(self, func, **params):
+        # the stored result of func(**params), or None when the parameters
+        # are not on the lattice
+        name = func.__name__
+        if name not in self.runs:
+            return None
+        if params.get("solver", "fixed_point") != "fixed_point":
+            return None
+        if params.get("mode", "discrete") != "discrete":
+            return None
+        if "daisies" in params["Albedo"]:
+            # only the two daisy types are stored
+            return None
+        if calc.params_key(**fixed_params(params)) != self.fixed:
+            return None
+
+        Albedo = params["Albedo"]
+        idx = [
+            _index(SLIDERS["Aw"], Albedo["w"]),
+            _index(SLIDERS["Ab"], Albedo["b"]),
+            _index(SLIDERS["Ap"], Albedo["none"]),
+            _index(SLIDERS["ins"], params["ins_p"]),
+        ]
+        if not np.isclose(params["Fsnom"], calc.update_solar_constant(calc.fromAU(1))):
+            # the varying flux experiment is stored for 1 AU only
+            return None
+        if any(i is None for i in idx):
+            return None
+
+        run = self.runs[name][tuple(idx)]
+        return run[0], run[1], run[2], calc.solar_flux_fractions()
+
+
+if __name__ == "__main__":
+    with open("init_vars.json") as infile:
+        init_vars = json.load(infile)
+    outdir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DIR
+    build(outdir, init_vars)
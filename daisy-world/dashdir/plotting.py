@@ -8,19 +8,18 @@ from plotly.subplots import make_subplots
 
 def initialize_albedo_plot(T_min, T_opt):
     # how does the growth curve of the Daisies look like?
-    gw = []
-    gb = []
     # amount of intervals to plot
     nt = 20
 
     t0 = 0
     t1 = 45
     dT = (t1 - t0) / nt
-    tempv = [t0 + i * dT for i in range(nt)]
+    tempv = t0 + dT * np.arange(nt)
 
-    for t in tempv:
-        gw.append(calc.DaisyGrowth(t + 273.15, "w", T_min, T_opt))
-        gb.append(calc.DaisyGrowth(t + 273.15, "b", T_min, T_opt))
+    # growth of both daisy types at all temperatures in one call
+    growth = calc.DaisyGrowth(tempv[:, None] + 273.15, ["w", "b"], T_min, T_opt)
+    gw = growth[:, 0]
+    gb = growth[:, 1]
 
     albedo_plot = go.Figure()
     albedo_plot.add_hrect(
@@ -48,8 +47,21 @@ def initialize_albedo_plot(T_min, T_opt):
     return albedo_plot
 
 
-def constant_flux_temp(
-    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+# The trace arrays that change with the sliders, in the trace order of the
+# figures below. The figure builders use them, and the app sends them to
+# figures that are already on the page as partial updates.
+def constant_flux_traces(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    mode="discrete",
 ):
 
     # initial areas are embedded in here but should be passed in as an
@@ -57,9 +69,52 @@ def constant_flux_temp(
     # externally...
     areas = {"w": 0.01, "b": 0.01}  # initial conditions for area
 
-    # solve the constant flux problem:
-    xgens, gens = calc.update_constant_flux(
-        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, areas
+    # solve the constant flux problem (shared by both figures):
+    xgens, gens = calc.simulation_cache.run(
+        calc.update_constant_flux,
+        Fsnom=Fsnom,
+        Albedo=Albedo,
+        rat=rat,
+        em_p=em_p,
+        sig=sig,
+        ins_p=ins_p,
+        death=death,
+        minarea=minarea,
+        T_min=T_min,
+        T_opt=T_opt,
+        areas=areas,
+        mode=mode,
+    )
+
+    temp = [
+        dict(y=xgens[:, calc.TW] - 273.15),
+        dict(y=xgens[:, calc.TB] - 273.15),
+        dict(y=xgens[:, calc.TP] - 273.15),
+    ]
+    area = [
+        dict(y=100 * xgens[:, calc.SW]),
+        dict(y=100 * xgens[:, calc.SB]),
+        dict(y=100 * xgens[:, calc.SU]),
+        dict(y=xgens[:, calc.AP]),
+    ]
+    return gens, temp, area
+
+
+def constant_flux_temp(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    mode="discrete",
+):
+    gens, temp, _ = constant_flux_traces(
+        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, mode
     )
 
     # temperatures plot
@@ -80,7 +135,7 @@ def constant_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=gens,
-            y=[x["Tw"] - 273.15 for x in xgens],
+            **temp[0],
             name="White daisies temperature",
             line=dict(color="lavender", width=8),
         )
@@ -88,7 +143,7 @@ def constant_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=gens,
-            y=[x["Tb"] - 273.15 for x in xgens],
+            **temp[1],
             name="Black daisies temperature",
             line=dict(color="black", width=3),
         )
@@ -96,7 +151,7 @@ def constant_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=gens,
-            y=[x["Tp"] - 273.15 for x in xgens],
+            **temp[2],
             name="Planet temperature",
             line=dict(color="seagreen", width=5, dash="dot"),
         )
@@ -114,17 +169,20 @@ def constant_flux_temp(
 
 
 def constant_flux_area(
-    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    mode="discrete",
 ):
-
-    # initial areas are embedded in here but should be passed in as an
-    # argument later if we want to change the initial conditions
-    # externally...
-    areas = {"w": 0.01, "b": 0.01}  # initial conditions for area
-
-    # solve the constant flux problem:
-    xgens, gens = calc.update_constant_flux(
-        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, areas
+    gens, _, area = constant_flux_traces(
+        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, mode
     )
 
     # make the figure:
@@ -146,7 +204,7 @@ def constant_flux_area(
     fig.add_trace(
         go.Scatter(
             x=gens,
-            y=[100 * x["Sw"] for x in xgens],
+            **area[0],
             name="White daisies area",
             line=dict(color="lavender", width=8),
         ),
@@ -155,7 +213,7 @@ def constant_flux_area(
     fig.add_trace(
         go.Scatter(
             x=gens,
-            y=[100 * x["Sb"] for x in xgens],
+            **area[1],
             name="Black daisies area",
             line=dict(color="black", width=3),
         ),
@@ -164,7 +222,7 @@ def constant_flux_area(
     fig.add_trace(
         go.Scatter(
             x=gens,
-            y=[100 * x["Su"] for x in xgens],
+            **area[2],
             name="Uninhabited area",
             line=dict(color="saddlebrown", width=4),
         ),
@@ -173,7 +231,7 @@ def constant_flux_area(
     fig.add_trace(
         go.Scatter(
             x=gens,
-            y=[x["Ap"] for x in xgens],
+            **area[3],
             name="Combined albedo",
             line=dict(color="royalblue", dash="dash"),
         ),
@@ -193,19 +251,95 @@ def constant_flux_area(
     return fig
 
 
-def varying_solar_flux_temp(
-    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+def _tipping_lines(Fcrit, F, Fsnom):
+    # vertical lines (one NaN separated trace) at the tipping points, placed
+    # on the time axis, labelled with the critical flux at the top
+    pos = (np.asarray(Fcrit) - F[0]) / (F[1] - F[0])
+    x = np.repeat(pos, 3)
+    y = np.tile([-20.0, 80.0, np.nan], len(pos))
+    x[2::3] = np.nan
+    text = np.tile(["", "", ""], len(pos)).astype(object)
+    text[1::3] = ["{:.0f} Wm-2".format(f * Fsnom) for f in Fcrit]
+    return dict(x=x, y=y, text=text)
+
+
+def varying_solar_flux_traces(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    solver="fixed_point",
 ):
-    xeq, xeqbar, _, F = calc.update_equi_flux(
-        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+    params = dict(
+        Fsnom=Fsnom,
+        Albedo=Albedo,
+        rat=rat,
+        em_p=em_p,
+        sig=sig,
+        ins_p=ins_p,
+        death=death,
+        minarea=minarea,
+        T_min=T_min,
+        T_opt=T_opt,
     )
-    # fig = go.Figure(data=go.Scatter(x=F, y=[x["Tw"] - 273.15 for x in xeq]))
-    ##
-    # # fig = make_subplots(rows=1, cols=2, subplot_titles=("Plot1", "Plot2"))
+    xeq, xeqbar, _, F = calc.simulation_cache.run(
+        calc.update_equi_flux, solver=solver, **params
+    )
+    # the tipping points of the forward sweep, located by bisection to a
+    # finer flux resolution than the sweep
+    Fcrit, appear, _ = calc.tipping_points(xeq, F, **params)
 
     # make a list of arbitrary times to plot against
     times = np.arange(0, len(F) + 1, 1)
 
+    # the flux steps where the planet did not settle to an equilibrium
+    unsettled = np.flatnonzero(xeq[:, calc.ST] != calc.CONVERGED)
+
+    temp = [
+        dict(y=F * Fsnom),
+        dict(y=xeq[:, calc.TW] - 273.15),
+        dict(y=xeq[:, calc.TB] - 273.15),
+        dict(y=xeq[:, calc.TP] - 273.15),
+        dict(y=xeqbar[:, calc.TP] - 273.15),
+        dict(x=times[unsettled], y=xeq[unsettled, calc.TP] - 273.15),
+        _tipping_lines(Fcrit[appear], F, Fsnom),
+        _tipping_lines(Fcrit[~appear], F, Fsnom),
+    ]
+    area = [
+        dict(y=F * Fsnom),
+        dict(y=100 * xeq[:, calc.SW]),
+        dict(y=100 * xeq[:, calc.SB]),
+        dict(y=100 * xeq[:, calc.SU]),
+    ]
+    return times, temp, area
+
+
+def varying_solar_flux_temp(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    solver="fixed_point",
+):
+    times, temp, _ = varying_solar_flux_traces(
+        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, solver
+    )
+    # fig = go.Figure(data=go.Scatter(x=F, y=xeq[:, calc.TW] - 273.15))
+    ##
+    # # fig = make_subplots(rows=1, cols=2, subplot_titles=("Plot1", "Plot2"))
+
     fig = make_subplots(specs=[[{"secondary_y": True}]])
     fig.add_hrect(
         xref="paper",
@@ -225,7 +359,7 @@ def varying_solar_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[Fi * Fsnom for Fi in F],
+            **temp[0],
             name="Solar flux (right axis)",
             line=dict(color="rgba(255, 255, 0, 0.3)", width=5),
         ),
@@ -234,7 +368,7 @@ def varying_solar_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[x["Tw"] - 273.15 for x in xeq],
+            **temp[1],
             name="White daisies temperature",
             line=dict(color="lavender", width=7),
         ),
@@ -243,7 +377,7 @@ def varying_solar_flux_temp(
     # fig.add_trace(
     #     go.Scatter(
     #         x=F,
-    #         y=[x["Tw"] - 273.15 for x in xeqinv],
+    #         y=xeqinv[:, calc.TW] - 273.15,
     #         name="White daisies temperature (backwards)",
     #         line=dict(color="lightskyblue", dash="dot", width=5),
     #     ),
@@ -251,7 +385,7 @@ def varying_solar_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[x["Tb"] - 273.15 for x in xeq],
+            **temp[2],
             name="Black daisies temperature",
             line=dict(color="black", width=3),
         ),
@@ -260,7 +394,7 @@ def varying_solar_flux_temp(
     # fig.add_trace(
     #     go.Scatter(
     #         x=F,
-    #         y=[x["Tb"] - 273.15 for x in xeqinv],
+    #         y=xeqinv[:, calc.TB] - 273.15,
     #         name="Black daisies temperature (backwards)",
     #         line=dict(color="darkslategray", dash="dot", width=3),
     #     ),
@@ -268,7 +402,7 @@ def varying_solar_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[x["Tp"] - 273.15 for x in xeq],
+            **temp[3],
             name="Planet temperature",
             line=dict(color="seagreen", width=5, dash="dot"),
         ),
@@ -277,7 +411,7 @@ def varying_solar_flux_temp(
     # fig.add_trace(
     #     go.Scatter(
     #         x=F,
-    #         y=[x["Tp"] - 273.15 for x in xeqinv],
+    #         y=xeqinv[:, calc.TP] - 273.15,
     #         name="Planet temperature (backwards)",
     #         line=dict(color="sienna", dash="dot", width=3),
     #     ),
@@ -285,12 +419,43 @@ def varying_solar_flux_temp(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[x["Tp"] - 273.15 for x in xeqbar],
+            **temp[4],
             name="Planet temperature (without life)",
             line=dict(color="gray", dash="dash", width=3),
         ),
         secondary_y=False,
     )
+    # mark the flux steps where the planet did not settle to an equilibrium
+    fig.add_trace(
+        go.Scatter(
+            **temp[5],
+            mode="markers",
+            name="Not settled (oscillating)",
+            marker=dict(color="crimson", symbol="x", size=7),
+        ),
+        secondary_y=False,
+    )
+    # and the tipping points
+    fig.add_trace(
+        go.Scatter(
+            **temp[6],
+            mode="lines+text",
+            textposition="top left",
+            name="Daisies appear",
+            line=dict(color="darkgreen", dash="dot", width=2),
+        ),
+        secondary_y=False,
+    )
+    fig.add_trace(
+        go.Scatter(
+            **temp[7],
+            mode="lines+text",
+            textposition="top right",
+            name="Daisies collapse",
+            line=dict(color="crimson", dash="dot", width=2),
+        ),
+        secondary_y=False,
+    )
 
     fig.update_xaxes(title="Simulation Time [Myr]", range=[0, times[-1]])
     fig.update_yaxes(
@@ -306,15 +471,22 @@ def varying_solar_flux_temp(
 
 
 def varying_solar_flux_area(
-    Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    solver="fixed_point",
 ):
-    xeq, _, _, F = calc.update_equi_flux(
-        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt
+    times, _, area = varying_solar_flux_traces(
+        Fsnom, Albedo, rat, em_p, sig, ins_p, death, minarea, T_min, T_opt, solver
     )
-
-    # make a list of arbitrary times to plot against
-    times = np.arange(0, len(F) + 1, 1)
-    # fig = go.Figure(data=go.Scatter(x=F, y=[x["Tw"] - 273.15 for x in xeq]))
+    # fig = go.Figure(data=go.Scatter(x=F, y=xeq[:, calc.TW] - 273.15))
     ##
     # # fig = make_subplots(rows=1, cols=2, subplot_titles=("Plot1", "Plot2"))
     fig = make_subplots(specs=[[{"secondary_y": True}]])
@@ -336,7 +508,7 @@ def varying_solar_flux_area(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[Fi * Fsnom for Fi in F],
+            **area[0],
             name="Solar flux (right axis)",
             line=dict(color="rgba(255, 255, 0, 0.3)", width=5),
         ),
@@ -345,7 +517,7 @@ def varying_solar_flux_area(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[100 * x["Sw"] for x in xeq],
+            **area[1],
             name="White daisies area",
             line=dict(color="lavender", width=7),
         ),
@@ -354,7 +526,7 @@ def varying_solar_flux_area(
     # fig.add_trace(
     #     go.Scatter(
     #         x=F,
-    #         y=[x["Sw"] for x in xeqinv],
+    #         y=xeqinv[:, calc.SW],
     #         name="White daisies area (backwards)",
     #         line=dict(color="lightskyblue", dash="dot", width=5),
     #     ),
@@ -362,7 +534,7 @@ def varying_solar_flux_area(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[100 * x["Sb"] for x in xeq],
+            **area[2],
             name="Black daisies area",
             line=dict(color="black", width=3),
         ),
@@ -371,7 +543,7 @@ def varying_solar_flux_area(
     # fig.add_trace(
     #     go.Scatter(
     #         x=F,
-    #         y=[x["Sb"] for x in xeqinv],
+    #         y=xeqinv[:, calc.SB],
     #         name="Black daisies area (backwards)",
     #         line=dict(color="darkslategray", dash="dot", width=3),
     #     ),
@@ -379,7 +551,7 @@ def varying_solar_flux_area(
     fig.add_trace(
         go.Scatter(
             x=times,
-            y=[100 * x["Su"] for x in xeq],
+            **area[3],
             name="Uninhabited area",
             line=dict(color="saddlebrown", width=3),
         ),
@@ -388,7 +560,7 @@ def varying_solar_flux_area(
     # fig.add_trace(
     #     go.Scatter(
     #         x=F,
-    #         y=[x["Su"] for x in xeqinv],
+    #         y=xeqinv[:, calc.SU],
     #         name="Uninhabited area (backwards)",
     #         line=dict(color="sienna", dash="dot", width=3),
     #     ),
@@ -404,3 +576,229 @@ def varying_solar_flux_area(
     fig.update_layout(title_text="Equilibrium area vs solar flux")
     fig.update_layout(plot_bgcolor="silver")
     return fig
+
+
+def transient_flux_traces(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    nsteps=100000,
+    decimate=100,
+):
+    # initial conditions for area, as in the constant flux experiment
+    areas = {"w": 0.01, "b": 0.01}
+
+    # the ramp is stepped chunk by chunk and only every decimate-th
+    # generation is kept, so only the downsampled trajectory reaches here
+    gens, frac, xs = calc.simulation_cache.run(
+        calc.transient_flux,
+        Fsnom=Fsnom,
+        Albedo=Albedo,
+        rat=rat,
+        em_p=em_p,
+        sig=sig,
+        ins_p=ins_p,
+        death=death,
+        minarea=minarea,
+        T_min=T_min,
+        T_opt=T_opt,
+        areas=areas,
+        nsteps=nsteps,
+        decimate=decimate,
+    )
+
+    temp = [
+        dict(y=frac * Fsnom),
+        dict(y=xs[:, calc.TW] - 273.15),
+        dict(y=xs[:, calc.TB] - 273.15),
+        dict(y=xs[:, calc.TP] - 273.15),
+    ]
+    area = [
+        dict(y=frac * Fsnom),
+        dict(y=100 * xs[:, calc.SW]),
+        dict(y=100 * xs[:, calc.SB]),
+        dict(y=100 * xs[:, calc.SU]),
+    ]
+    return gens, temp, area
+
+
+def _transient_figure(gens, traces, names, colors):
+    # flux on the right axis, the model variables on the left
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig.update_xaxes(showgrid=True, zeroline=False)
+    fig.update_yaxes(showgrid=True, zeroline=False, secondary_y=False)
+    fig.update_yaxes(showgrid=False, zeroline=False, secondary_y=True)
+    fig.add_trace(
+        go.Scatter(
+            x=gens,
+            **traces[0],
+            name="Solar flux (right axis)",
+            line=dict(color="rgba(255, 255, 0, 0.3)", width=5),
+        ),
+        secondary_y=True,
+    )
+    for trace, name, color in zip(traces[1:], names, colors):
+        fig.add_trace(
+            go.Scatter(x=gens, **trace, name=name, line=dict(color=color, width=3)),
+            secondary_y=False,
+        )
+    fig.update_xaxes(title="Simulation Time (Daisy generation #)", range=[0, gens[-1]])
+    fig.update_yaxes(title_text="Solar flux [Wm-2]", secondary_y=True)
+    fig.update_layout(plot_bgcolor="silver")
+    return fig
+
+
+def transient_flux_temp(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    nsteps=100000,
+    decimate=100,
+):
+    gens, temp, _ = transient_flux_traces(
+        Fsnom,
+        Albedo,
+        rat,
+        em_p,
+        sig,
+        ins_p,
+        death,
+        minarea,
+        T_min,
+        T_opt,
+        nsteps,
+        decimate,
+    )
+    fig = _transient_figure(
+        gens,
+        temp,
+        [
+            "White daisies temperature",
+            "Black daisies temperature",
+            "Planet temperature",
+        ],
+        ["lavender", "black", "seagreen"],
+    )
+    fig.update_yaxes(title="Temperature [degC]", range=[-20, 80], secondary_y=False)
+    fig.update_layout(title_text="Transient temperature under a luminosity ramp")
+    return fig
+
+
+def transient_flux_area(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    nsteps=100000,
+    decimate=100,
+):
+    gens, _, area = transient_flux_traces(
+        Fsnom,
+        Albedo,
+        rat,
+        em_p,
+        sig,
+        ins_p,
+        death,
+        minarea,
+        T_min,
+        T_opt,
+        nsteps,
+        decimate,
+    )
+    fig = _transient_figure(
+        gens,
+        area,
+        ["White daisies area", "Black daisies area", "Uninhabited area"],
+        ["lavender", "black", "saddlebrown"],
+    )
+    fig.update_yaxes(title="Inhabited area [%]", range=[0, 100], secondary_y=False)
+    fig.update_layout(title_text="Transient area under a luminosity ramp")
+    return fig
+
+
+def grid_flux_map(
+    Fsnom,
+    Albedo,
+    rat,
+    em_p,
+    sig,
+    ins_p,
+    death,
+    minarea,
+    T_min,
+    T_opt,
+    field="cover",
+):
+
+    # same initial areas as the zero-dimensional constant flux experiment
+    areas = {"w": 0.01, "b": 0.01}  # initial conditions for area
+
+    # solve the spatial constant flux problem:
+    x, xmean, lat = calc.simulation_cache.run(
+        calc.update_grid_flux,
+        Fsnom=Fsnom,
+        Albedo=Albedo,
+        rat=rat,
+        em_p=em_p,
+        sig=sig,
+        ins_p=ins_p,
+        death=death,
+        minarea=minarea,
+        T_min=T_min,
+        T_opt=T_opt,
+        areas=areas,
+    )
+    nlon = x.shape[1]
+    lon = (np.arange(nlon) + 0.5) * 360 / nlon - 180
+
+    if field == "cover":
+        # white daisies positive, black daisies negative
+        z = 100 * (x[..., calc.SW] - x[..., calc.SB])
+        colorscale = [[0, "black"], [0.5, "saddlebrown"], [1, "lavender"]]
+        zrange = dict(zmin=-100, zmax=100)
+        title = "White minus black daisy area [%]"
+    elif field == "temp":
+        z = x[..., calc.TP] - 273.15
+        colorscale = "RdBu_r"
+        zrange = {}
+        title = "Planetary temperature [degC]"
+    else:
+        raise ValueError("unknown field: " + str(field))
+
+    # make the figure:
+    fig = go.Figure()
+    fig.add_trace(
+        go.Heatmap(
+            x=lon,
+            y=np.degrees(lat),
+            z=z,
+            colorscale=colorscale,
+            colorbar=dict(title=title),
+            **zrange,
+        )
+    )
+    fig.update_xaxes(title_text="Longitude [deg]", range=[-180, 180])
+    fig.update_yaxes(title_text="Latitude [deg]", range=[-90, 90])
+    fig.layout.title = "Spatial daisy world after {} generations".format(len(xmean))
+    return fig
@@ -0,0 +1,112 @@
+# Checks of the equilibrium solvers of experiment 2: oscillations that die
+# down are followed until they converge, like the plain fixed point
+# iteration does, only cycles that keep their swing are averaged and the
+# adaptive continuation follows the fixed sweep.
+# Run from this directory with `python -m pytest test_equilibrium.py`.
+
+import json
+
+import numpy as np
+
+import calculations as calc
+
+with open("init_vars.json") as f:
+    init_vars = json.load(f)
+
+
+def parameters(Aw, Ab, Ap, ins_p):
+    params = json.loads(json.dumps(init_vars))
+    params["Albedo"] = {"none": Ap, "w": Aw, "b": Ab}
+    params["ins_p"] = ins_p
+    return params
+
+
+def fixed_point_sweeps(params):
+    # the forward and backward sweeps with the plain fixed point iteration,
+    # stepping until the temperature changes by at most 0.05 K
+    kernel_params = {k: v for k, v in params.items() if k != "Fsnom"}
+    start, step, _ = calc.state_kernels(**kernel_params)
+    F = calc.solar_flux_fractions() * params["Fsnom"]
+
+    def sweep(s, flux):
+        xs = [s]
+        for Fr in flux:
+            dT = 2
+            while dT > 0.05:
+                snew = step(s, Fr)
+                dT = abs(snew[calc.TP] - s[calc.TP])
+                s = snew
+            xs.append(s)
+        return np.array(xs)
+
+    xeq = sweep(start([0.01, 0.01], F[0]), F[1:])
+    xeqinv = sweep(xeq[-1].tolist(), F[::-1])
+    return xeq, xeqinv[::-1][1:]
+
+
+def test_decaying_oscillations_converge():
+    for Aw, Ab, Ap, ins_p in [(0.5, 0, 0.7, 0), (1, 0.25, 0.3, 0.5)]:
+        params = parameters(Aw, Ab, Ap, ins_p)
+        xeq, _, xeqinv, _ = calc.update_equi_flux(**params)
+        assert (xeq[:, calc.ST] == calc.CONVERGED).all()
+        assert (xeqinv[:, calc.ST] == calc.CONVERGED).all()
+
+        ref, refinv = fixed_point_sweeps(params)
+        np.testing.assert_allclose(xeq[:, : calc.ST], ref[:, : calc.ST], atol=1e-9)
+        np.testing.assert_allclose(
+            xeqinv[:, : calc.ST], refinv[:, : calc.ST], atol=1e-9
+        )
+
+
+def test_stable_cycle_is_averaged():
+    # a period 2 cycle with a swing of about 10 K at the flux step 120
+    params = parameters(1, 0, 0.3, 0.25)
+    xeq = calc.update_equi_flux(**params)[0]
+    assert xeq[120, calc.ST] == calc.OSCILLATING
+
+
+def test_batch_statuses_match_single_runs(monkeypatch):
+    # on the array kernels, with the last members handed over to floats
+    monkeypatch.setattr(calc, "ARRAY_BATCH", 0)
+    params = parameters(1, 0, 0.3, 0.5)
+    params["Albedo"]["b"] = np.linspace(0, 0.5, 12)
+    params["ins_p"] = np.tile([0.5, 0.25], 6)
+    batch = calc.update_equi_flux_batch(**params)
+    for k in range(12):
+        single = parameters(1, params["Albedo"]["b"][k], 0.3, params["ins_p"][k])
+        for xs, xb in zip(calc.update_equi_flux(**single)[:3], batch[:3]):
+            np.testing.assert_array_equal(xs, xb[:, k])
+
+
+def test_continuation_matches_fixed_sweep():
+    # the adaptive continuation finds the same tipping points as the fixed
+    # sweep and the same temperatures away from them
+    for Aw, Ab, Ap, ins_p in [
+        (
+            init_vars["Albedo"]["w"],
+            init_vars["Albedo"]["b"],
+            init_vars["Albedo"]["none"],
+            init_vars["ins_p"],
+        ),
+        (0.5, 0, 0.3, 0.25),
+        (0.75, 0.25, 0.3, 0.25),
+        (0.75, 0.5, 0.7, 0.25),
+    ]:
+        params = parameters(Aw, Ab, Ap, ins_p)
+        fixed = calc.update_equi_flux(**params)
+        adaptive = calc.update_equi_flux(**params, solver="adaptive")
+        for xf, xa in zip(fixed[:3], adaptive[:3]):
+            cf = calc.daisy_covered(xf, params["minarea"])
+            ca = calc.daisy_covered(xa, params["minarea"])
+            tips = np.flatnonzero(cf[1:] != cf[:-1])
+            np.testing.assert_array_equal(tips, np.flatnonzero(ca[1:] != ca[:-1]))
+
+            away = np.ones(len(xf), bool)
+            for t in tips:
+                away[max(t - 2, 0) : t + 4] = False
+            away &= (xf[:, calc.ST] == calc.CONVERGED) & (
+                xa[:, calc.ST] == calc.CONVERGED
+            )
+            np.testing.assert_allclose(
+                xa[away, calc.TP], xf[away, calc.TP], rtol=0, atol=0.5
+            )
@@ -3,13 +3,14 @@
 # This is the main file. It contains Dash setup and callbacks.
 
 import base64
-from os import environ
+from os import environ, path
 
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output
-from flask import Flask
+from flask import Flask, request
 
+import calibration as cal
 import plotting as plot
 
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
@@ -20,6 +21,25 @@ app = dash.Dash(
     requests_pathname_prefix='/hydro/',
     external_stylesheets=external_stylesheets)
 
+# The background image of the elevation plot is served once from the assets
+# folder and the figure only holds its url. The modification time in the url
+# changes whenever the file does, so browsers may cache the image for a year.
+background_file = "background.png"
+background_url = (
+    app.get_asset_url(background_file)
+    + "?m="
+    + str(int(path.getmtime(path.join("assets", background_file))))
+)
+
+
+@server.after_request
+def cache_background(response):
+    if request.path.endswith("/assets/" + background_file):
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+    return response
+
+
 # initial values for dash components
 initial_h1 = 35
 initial_h2 = 30
@@ -28,6 +48,8 @@ initial_W = 0.05
 initial_L = 800
 initial_material = "silty_sand"
 initial_arrow_visibility = ["visible"]
+initial_time = plot.TRANSIENT_SNAPSHOTS - 1
+initial_compare = []
 
 # load markdown for the header, introduction, sources.
 header = open("header.md", "r")
@@ -238,7 +260,18 @@ app.layout = html.Div(
                         {"label": "arrows visible", "value": "visible"},
                     ],
                     value=initial_arrow_visibility,
-                    style={"margin-bottom": "50px"},
+                    style={"margin-bottom": "20px"},
+                ),
+                dcc.Markdown(""" **Compare with:** """),
+                dcc.Checklist(
+                    # "what if" scenarios drawn dashed over the head and q plots
+                    id="compare",
+                    options=[
+                        {"label": label, "value": value}
+                        for value, (label, _) in plot.COMPARISONS.items()
+                    ],
+                    value=initial_compare,
+                    style={"margin-bottom": "30px"},
                 ),
                 html.Button(
                     "Reset", id="reset_button"
@@ -265,6 +298,45 @@ app.layout = html.Div(
             ],
             style={"width": "100%", "display": "inline-block"},
         ),
+        html.Div(
+            [
+                dcc.Markdown(
+                    """ **Time since the recharge _W_ was switched on:** """
+                ),
+                dcc.Slider(
+                    # steps through the stored snapshots of the transient run
+                    id="time",
+                    min=0,
+                    max=plot.TRANSIENT_SNAPSHOTS - 1,
+                    step=1,
+                    value=initial_time,
+                    marks={0: "start", plot.TRANSIENT_SNAPSHOTS - 1: "response time"},
+                ),
+                dcc.Graph(
+                    id="transient_plot",
+                ),
+                dcc.Graph(
+                    id="section_plot",
+                ),
+                dcc.Graph(
+                    id="particle_plot",
+                ),
+                dcc.Markdown(
+                    """ **Calibration:** upload observed heads as a csv file with the columns x, h (and optionally q) to fit _K_ and _W_ for the current _h1_, _h2_ and _L_. """
+                ),
+                dcc.Upload(
+                    # Dash Upload: https://dash.plotly.com/dash-core-components/upload
+                    id="observations",
+                    children=html.Button("Upload observations"),
+                ),
+                dcc.Markdown(id="calibration_label", children=""),
+                dcc.Graph(
+                    id="calibration_plot",
+                    figure=plot.calibration_plot(),
+                ),
+            ],
+            style={"width": "100%", "display": "inline-block"},
+        ),
         html.Div(
             [
                 dcc.Markdown(
@@ -295,8 +367,19 @@ elevation_plot = plot.initialize_elevation_plot(
     initial_W,
     initial_L,
     initial_arrow_visibility,
+    background_url,
+    initial_compare,
 )
 q_plot = plot.initialize_q_plot(
+    initial_h1, initial_h2, (10 ** initial_K), initial_W, initial_L, initial_compare
+)
+transient_plot = plot.initialize_transient_plot(
+    initial_h1, initial_h2, (10 ** initial_K), initial_W, initial_L, initial_time
+)
+section_plot = plot.initialize_section_plot(
+    initial_h1, initial_h2, (10 ** initial_K), initial_W, initial_L
+)
+particle_plot = plot.initialize_particle_plot(
     initial_h1, initial_h2, (10 ** initial_K), initial_W, initial_L
 )
 
@@ -393,11 +476,12 @@ def update_K_bounds(material):  # update values for K based on the ground materi
     Input(component_id="W", component_property="value"),
     Input(component_id="L", component_property="value"),
     Input(component_id="arrow_visibility", component_property="value"),
+    Input(component_id="compare", component_property="value"),
 )
-def update_elevation_plot(h1, h2, K, W, L, arrow_visibility):
+def update_elevation_plot(h1, h2, K, W, L, arrow_visibility, compare):
     # update the elevation plot by calling a function in the plotting file. Note since K is logarithmic, we pass 10^K.
     fig = plot.update_elevation_plot(
-        h1, h2, (10 ** (K)), W, L, arrow_visibility, elevation_plot
+        h1, h2, (10 ** (K)), W, L, arrow_visibility, elevation_plot, compare
     )
     return fig
 
@@ -409,13 +493,88 @@ def update_elevation_plot(h1, h2, K, W, L, arrow_visibility):
     Input(component_id="K", component_property="value"),
     Input(component_id="W", component_property="value"),
     Input(component_id="L", component_property="value"),
+    Input(component_id="compare", component_property="value"),
 )
-def update_q_plot(h1, h2, K, W, L):
+def update_q_plot(h1, h2, K, W, L, compare):
     # update the q plot by calling a function in the plotting file. Note since K is logarithmic, we pass 10^K.
-    fig = plot.update_q_plot(h1, h2, (10 ** (K)), W, L, q_plot)
+    fig = plot.update_q_plot(h1, h2, (10 ** (K)), W, L, q_plot, compare)
     return fig
 
 
+@app.callback(
+    Output(component_id="transient_plot", component_property="figure"),
+    Input(component_id="h1", component_property="value"),
+    Input(component_id="h2", component_property="value"),
+    Input(component_id="K", component_property="value"),
+    Input(component_id="W", component_property="value"),
+    Input(component_id="L", component_property="value"),
+    Input(component_id="time", component_property="value"),
+)
+def update_transient_plot(h1, h2, K, W, L, time):
+    # update the transient plot. The run is solved once per parameter set, the time slider only selects a snapshot.
+    fig = plot.update_transient_plot(
+        h1, h2, (10 ** (K)), W, L, time, transient_plot
+    )
+    return fig
+
+
+@app.callback(
+    Output(component_id="section_plot", component_property="figure"),
+    Input(component_id="h1", component_property="value"),
+    Input(component_id="h2", component_property="value"),
+    Input(component_id="K", component_property="value"),
+    Input(component_id="W", component_property="value"),
+    Input(component_id="L", component_property="value"),
+)
+def update_section_plot(h1, h2, K, W, L):
+    # update the layered section. Changing h1, h2 or W reuses the factorized system.
+    fig = plot.update_section_plot(h1, h2, (10 ** (K)), W, L, section_plot)
+    return fig
+
+
+@app.callback(
+    Output(component_id="particle_plot", component_property="figure"),
+    Input(component_id="h1", component_property="value"),
+    Input(component_id="h2", component_property="value"),
+    Input(component_id="K", component_property="value"),
+    Input(component_id="W", component_property="value"),
+    Input(component_id="L", component_property="value"),
+)
+def update_particle_plot(h1, h2, K, W, L):
+    # update the particle paths and travel times. Note since K is logarithmic, we pass 10^K.
+    fig = plot.update_particle_plot(h1, h2, (10 ** (K)), W, L, particle_plot)
+    return fig
+
+
+@app.callback(
+    Output(component_id="calibration_plot", component_property="figure"),
+    Output(component_id="calibration_label", component_property="children"),
+    Input(component_id="observations", component_property="contents"),
+    Input(component_id="h1", component_property="value"),
+    Input(component_id="h2", component_property="value"),
+    Input(component_id="L", component_property="value"),
+)
+def update_calibration(contents, h1, h2, L):
+    # fit K and W to the uploaded observations. The misfit grids are cached, so refitting the same data is cheap.
+    if contents is None:
+        return plot.calibration_plot(), ""
+    try:
+        x, h, q = cal.parse_observations(contents)
+        K, W, misfit, surfaces = cal.calibrate(x, h, h1, h2, L, q=q)
+    except ValueError as error:
+        return plot.calibration_plot(), "Could not read the observations: " + str(error)
+    text = (
+        """ Best fit: **_K_ = """
+        + str(K)[:5]
+        + """m/day**, **_W_ = """
+        + str(round(W, 4))
+        + """m/day**, rms misfit """
+        + str(round(misfit, 3))
+        + """m"""
+    )
+    return plot.calibration_plot(surfaces, K, W), text
+
+
 @app.callback(
     Output(component_id="h1", component_property="value"),
     Output(component_id="h2", component_property="value"),
@@ -424,6 +583,7 @@ def update_q_plot(h1, h2, K, W, L):
     Output(component_id="L", component_property="value"),
     Output(component_id="arrow_visibility", component_property="value"),
     Output(component_id="material", component_property="value"),
+    Output(component_id="compare", component_property="value"),
     Input(component_id="reset_button", component_property="n_clicks"),
 )
 def reset_page(n_clicks):
@@ -436,6 +596,7 @@ def reset_page(n_clicks):
         initial_L,
         initial_arrow_visibility,
         initial_material,
+        initial_compare,
     )
 
 
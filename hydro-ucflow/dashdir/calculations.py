@@ -2,6 +2,9 @@
 # The functions all just correspond to equations.
 
 import numpy as np
+from scipy import sparse
+from scipy.linalg import solve_banded
+from scipy.sparse.linalg import splu
 
 
 def get_d(h1, h2, K, W, L):  # calculate divide, d
@@ -18,16 +21,254 @@ def get_h(h1, h2, K, W, L, x):  # calculate elevation, h
     return h
 
 
-def get_h_max(h1, h2, K, W, L):  # calculate the max value of h
-    d = get_d(h1, h2, K, W, L)
-    h = np.real(
-        np.sqrt(
-            (h1 ** 2) - (((h1 ** 2 - h2 ** 2) * d) / L) + ((W / K) * (L - d) * d) + 0j
-        )
-    )
-    return h
-
-
 def get_q(h1, h2, K, W, L, x):
     q = ((K * (h1 ** 2 - h2 ** 2)) / (2 * L)) - (W * ((L / 2) - x))
     return q
+
+
+def get_scenarios(scenarios, nx=1000):
+    # get_h, get_q and get_d for many (h1, h2, K, W, L) tuples at once: the
+    # parameters are columns and broadcast against the nx points along each
+    # profile. Returns x, h and q as (nscenarios, nx) arrays and d as an
+    # (nscenarios,) array (h1 where there is no recharge, as in get_d).
+    h1, h2, K, W, L = np.asarray(scenarios, dtype=float).reshape(-1, 5).T[:, :, None]
+    x = L * np.linspace(0, 1, nx)
+    h = get_h(h1, h2, K, W, L, x)
+    q = get_q(h1, h2, K, W, L, x)
+    recharge = W != 0
+    d = np.where(
+        recharge,
+        (L / 2) - (K / np.where(recharge, W, 1)) * ((h1 ** 2 - h2 ** 2) / (2 * L)),
+        h1,
+    )
+    return x, h, q, d[:, 0]
+
+
+def track_particles(h1, h2, K, W, L, porosity=0.3, nparticles=1000, nsteps=200):
+    # paths and travel times of particles released at nparticles points
+    # along the water table, all advanced together in nsteps steps to the
+    # boundary they leave through. The particles move with q / (porosity h);
+    # by the Dupuit assumption the flow below a particle stays q at its
+    # release point, so its depth is z = h q(x0) / q(x).
+    # With recharge q = W (x - d), so the steps are taken in ln|x - d|, along
+    # which the travel time grows smoothly even next to the divide.
+    # Returns the release points x0, the travel times (days) and the paths
+    # x, z and the times t along them as (nparticles, nsteps) arrays.
+    # With discharge (W < 0) nothing enters the water table: all NaN.
+    x0 = (np.arange(nparticles) + 0.5) * L / nparticles
+    if W < 0:
+        nan = np.full((nparticles, nsteps), np.nan)
+        return x0, nan[:, -1], nan, nan, nan
+    q0 = get_q(h1, h2, K, W, L, x0)
+    x_exit = np.where(q0 < 0, 0.0, np.where(q0 > 0, float(L), x0))
+    u = np.linspace(0, 1, nsteps)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if W > 0:
+            d = get_d(h1, h2, K, W, L)
+            span = np.log((x_exit - d) / (x0 - d))[:, None]
+            x = d + (x0 - d)[:, None] * np.exp(span * u)
+            h = get_h(h1, h2, K, W, L, x)
+            z = h * np.exp(-span * u)
+            rate = porosity * h / W
+            step = span / (nsteps - 1)
+        elif W == 0:
+            x = x0[:, None] + (x_exit - x0)[:, None] * u
+            h = get_h(h1, h2, K, W, L, x)
+            z = h
+            rate = porosity * h / np.abs(q0)[:, None]
+            step = np.abs(x_exit - x0)[:, None] / (nsteps - 1)
+
+        t = np.zeros((nparticles, nsteps))
+        t[:, 1:] = np.cumsum((rate[:, :-1] + rate[:, 1:]) / 2 * step, axis=1)
+        # particles that never leave (no flow at all, or released on the divide)
+        t[np.isnan(t)] = np.inf
+    return x0, t[:, -1], x, z, t
+
+
+def boussinesq_step(h, h1, h2, K, W, dx, dt, Sy, tol=1e-6, maxiter=50):
+    # one implicit time step of the 1-D Boussinesq equation
+    # Sy dh/dt = K d/dx(h dh/dx) + W on the nodes h (h[0] = h1, h[-1] = h2).
+    # With the mean of two nodes as transmissivity the flux between them is
+    # K (h_j^2 - h_i^2) / (2 dx) and the steady state of the scheme is
+    # exactly get_h at the nodes. The nonlinear system is solved by Newton's
+    # method on its banded tridiagonal Jacobian. With discharge (W < 0) the
+    # water table can reach the bottom of the aquifer: such dry nodes are
+    # held at h = 0 until their neighbours deliver more than W takes out.
+    # Returns the heads and whether the iteration converged.
+    c = K * dt / (Sy * dx ** 2)
+    h_old = h
+    h = h.copy()
+    h[0] = h1
+    h[-1] = h2
+    n = len(h) - 2
+    J = np.zeros((3, n))
+    dry = np.zeros(n, dtype=bool)
+    # no head can rise above this, Newton steps that overshoot are cut back
+    h_top = max(h1, h2, h_old.max()) + max(W, 0) * dt / Sy
+    for _ in range(maxiter):
+        u = h ** 2
+        inflow = h_old[1:-1] + W * dt / Sy + c / 2 * (u[2:] + u[:-2])
+        F = h[1:-1] + c * u[1:-1] - inflow
+        J[0, 1:] = -c * h[2:-1]
+        J[1] = 1 + 2 * c * h[1:-1]
+        J[2, :-1] = -c * h[1:-2]
+        # dry nodes stay at h = 0
+        F[dry] = h[1:-1][dry]
+        J[1, dry] = 1
+        J[0, 1:][dry[:-1]] = 0
+        J[2, :-1][dry[1:]] = 0
+        h_new = h[1:-1] - solve_banded((1, 1), J, F)
+
+        # nodes dry out when they drop below the bottom and get wet again
+        # when they would fill up with h = 0. A node that gets wet again
+        # starts from its own head with the neighbours as they are, Newton
+        # steps from h = 0 overshoot it by far.
+        wet = (dry & (inflow > 0)) | (~dry & (h_new >= 0))
+        h_new = np.clip(h_new, 0, h_top)
+        rewet = dry & wet
+        h_new[rewet] = 2 * inflow[rewet] / (1 + np.sqrt(1 + 4 * c * inflow[rewet]))
+        change = np.max(np.abs(h_new - h[1:-1]))
+        h[1:-1] = h_new
+        if change < tol and (dry == ~wet).all():
+            return h, True
+        dry = ~wet
+    return h, False
+
+
+def get_h_transient(h0, h1, h2, K, W, L, t, Sy=0.2, nx=201, substeps=4):
+    # water table at the times t (in days) from the initial heads h0 (an array
+    # on the nx nodes or one value), for the boundary heads h1, h2 and the
+    # recharge W: one value, or one per interval between the times in t.
+    # Each interval is solved in substeps implicit steps. Returns the nodes x,
+    # the heads as a (len(t), nx) array, one row per time, and whether every
+    # step up to each time converged.
+    x = np.linspace(0, L, nx)
+    dx = x[1] - x[0]
+    t = np.asarray(t, dtype=float)
+    W = np.broadcast_to(np.asarray(W, dtype=float), (len(t) - 1,))
+
+    h = np.empty((len(t), nx))
+    h[0] = h0
+    h[0, 0] = h1
+    h[0, -1] = h2
+    converged = np.ones(len(t), dtype=bool)
+    for n in range(len(t) - 1):
+        dt = (t[n + 1] - t[n]) / substeps
+        hn = h[n]
+        converged[n + 1] = converged[n]
+        for _ in range(substeps):
+            hn, ok = boussinesq_step(hn, h1, h2, K, W[n], dx, dt, Sy)
+            converged[n + 1] &= ok
+        h[n + 1] = hn
+    return x, h, converged
+
+
+def response_time(h1, h2, K, L, Sy=0.2):
+    # time scale (days) on which the water table adjusts, Sy L^2 / (K h)
+    return Sy * L ** 2 / (K * max((h1 + h2) / 2, 1e-3))
+
+
+# factorizations of the section system, by grid and conductivity field
+_section_factors = {}
+SECTION_FACTORS_MAX = 8
+
+
+def zoned_K(K, zones, L, D, nx=200, nz=50):
+    # conductivity of the nz x nx cells of a vertical section of length L
+    # and thickness D: K everywhere except in the zones, which are
+    # (x0, x1, z0, z1, K) rectangles (z from the bottom). Later zones win,
+    # so layers and lenses can be stacked.
+    x = (np.arange(nx) + 0.5) * L / nx
+    z = (np.arange(nz) + 0.5) * D / nz
+    Kfield = np.full((nz, nx), float(K))
+    for x0, x1, z0, z1, Kzone in zones:
+        inside = ((z >= z0) & (z <= z1))[:, None] & ((x >= x0) & (x <= x1))[None, :]
+        Kfield[inside] = Kzone
+    return Kfield
+
+
+def _section_conductances(Kfield, L, D):
+    # conductances between neighbouring cells (harmonic mean of K) and from
+    # the side cells to the fixed heads on the left and right faces
+    nz, nx = Kfield.shape
+    dx = L / nx
+    dz = D / nz
+    Tx = 2 / (1 / Kfield[:, :-1] + 1 / Kfield[:, 1:]) * dz / dx
+    Tz = 2 / (1 / Kfield[:-1, :] + 1 / Kfield[1:, :]) * dx / dz
+    Tleft = 2 * Kfield[:, 0] * dz / dx
+    Tright = 2 * Kfield[:, -1] * dz / dx
+    return Tx, Tz, Tleft, Tright
+
+
+def section_factor(Kfield, L, D):
+    # sparse LU factorization of the steady flow equations div(K grad h) = 0
+    # on the section. The matrix only depends on the grid and K, so it is
+    # factorized once and kept; boundary heads and recharge only enter the
+    # right hand side.
+    key = (Kfield.shape, float(L), float(D), Kfield.tobytes())
+    if key in _section_factors:
+        return _section_factors[key]
+
+    nz, nx = Kfield.shape
+    Tx, Tz, Tleft, Tright = _section_conductances(Kfield, L, D)
+    cells = np.arange(nz * nx).reshape(nz, nx)
+    diag = np.zeros((nz, nx))
+    diag[:, :-1] += Tx
+    diag[:, 1:] += Tx
+    diag[:-1, :] += Tz
+    diag[1:, :] += Tz
+    diag[:, 0] += Tleft
+    diag[:, -1] += Tright
+    rows = np.concatenate(
+        [cells.ravel(), cells[:, :-1].ravel(), cells[:, 1:].ravel()]
+        + [cells[:-1, :].ravel(), cells[1:, :].ravel()]
+    )
+    cols = np.concatenate(
+        [cells.ravel(), cells[:, 1:].ravel(), cells[:, :-1].ravel()]
+        + [cells[1:, :].ravel(), cells[:-1, :].ravel()]
+    )
+    vals = np.concatenate(
+        [diag.ravel(), -Tx.ravel(), -Tx.ravel(), -Tz.ravel(), -Tz.ravel()]
+    )
+    A = sparse.csc_matrix((vals, (rows, cols)), shape=(nz * nx, nz * nx))
+    factor = splu(A)
+
+    if len(_section_factors) >= SECTION_FACTORS_MAX:
+        _section_factors.pop(next(iter(_section_factors)))
+    _section_factors[key] = factor
+    return factor
+
+
+def get_section(h1, h2, W, Kfield, L, D=50):
+    # steady heads and specific discharge in a vertical section with the
+    # conductivity field Kfield (nz x nx cells, row 0 at the bottom), fixed
+    # heads h1 and h2 on the left and right faces, recharge W on the top and
+    # no flow through the bottom. Returns the cell centres x, z, the heads
+    # (nz, nx) and the horizontal and vertical discharge qx, qz (m/day) at
+    # the cell centres.
+    nz, nx = Kfield.shape
+    dx = L / nx
+    dz = D / nz
+    Tx, Tz, Tleft, Tright = _section_conductances(Kfield, L, D)
+
+    b = np.zeros((nz, nx))
+    b[:, 0] += Tleft * h1
+    b[:, -1] += Tright * h2
+    b[-1, :] += W * dx
+    h = section_factor(Kfield, L, D).solve(b.ravel()).reshape(nz, nx)
+
+    # discharge through the cell faces, then averaged to the cell centres
+    fx = np.empty((nz, nx + 1))
+    fx[:, 0] = Tleft * (h1 - h[:, 0])
+    fx[:, 1:-1] = Tx * (h[:, :-1] - h[:, 1:])
+    fx[:, -1] = Tright * (h[:, -1] - h2)
+    fz = np.zeros((nz + 1, nx))
+    fz[1:-1, :] = Tz * (h[:-1, :] - h[1:, :])
+    fz[-1, :] = -W * dx
+    qx = (fx[:, :-1] + fx[:, 1:]) / (2 * dz)
+    qz = (fz[:-1, :] + fz[1:, :]) / (2 * dx)
+
+    x = (np.arange(nx) + 0.5) * dx
+    z = (np.arange(nz) + 0.5) * dz
+    return x, z, h, qx, qz
@@ -0,0 +1,114 @@
+# This file fits the model to observations. It is called by app.py.
+# Observed heads h at positions x (and optionally discharges q) are compared
+# with calc.get_h (and calc.get_q) on a grid of (K, W), which is then refined
+# around the best fit.
+# Note that the heads alone only fix the ratio W / K: the misfit surface has
+# a valley along it. Discharge observations pin down K (and so W).
+
+import base64
+import io
+from functools import lru_cache
+
+import numpy as np
+
+import calculations as calc
+
+# search range of log10(K) and W: all the K slider ranges of the materials
+# (see update_K_bounds in app.py) and the W slider
+LOG_K_RANGE = (-4, 5)
+W_RANGE = (-0.05, 0.1)
+
+
+def parse_observations(contents):
+    # the x, h (and q) columns of an uploaded csv file with a header line,
+    # e.g. "x,h" or "x,h,q". contents is the data url of a dcc.Upload.
+    data = base64.b64decode(contents.split(",", 1)[1]).decode("utf-8")
+    if not data.strip():
+        raise ValueError("the file is empty")
+    table = np.genfromtxt(io.StringIO(data), delimiter=",", names=True)
+    table = np.atleast_1d(table)
+    if table.dtype.names is None:
+        raise ValueError("the file needs a header line, e.g. x,h")
+    names = [n.lower() for n in table.dtype.names]
+    if "x" not in names or "h" not in names:
+        raise ValueError("the file needs x and h columns")
+    columns = {
+        n: np.asarray(table[name], dtype=float)
+        for n, name in zip(names, table.dtype.names)
+    }
+    return finite_observations(columns["x"], columns["h"], columns.get("q"))
+
+
+def finite_observations(x, h, q=None):
+    # the observations without the rows that lack a position or a head
+    # (e.g. blank cells); a missing discharge only drops that discharge
+    x = np.asarray(x, dtype=float)
+    h = np.asarray(h, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(h)
+    if not keep.any():
+        raise ValueError("no rows with both x and h")
+    if q is not None:
+        q = np.asarray(q, dtype=float)[keep]
+    return x[keep], h[keep], q
+
+
+@lru_cache(maxsize=64)
+def _misfit_surface(observations, h1, h2, L, log_K, W, q_weight):
+    # rms misfit for all (K, W) of a grid. Everything is passed as bytes or
+    # numbers so surfaces are cached per data set and grid.
+    x, h, xq, q = [np.frombuffer(b) for b in observations]
+    log_K = np.frombuffer(log_K)
+    W = np.frombuffer(W)
+    K = 10 ** log_K[:, None, None]
+    Wg = W[None, :, None]
+
+    squares = np.mean((calc.get_h(h1, h2, K, Wg, L, x) - h) ** 2, axis=-1)
+    if len(q):
+        residual = calc.get_q(h1, h2, K, Wg, L, xq) - q
+        squares = squares + q_weight * np.mean(residual ** 2, axis=-1)
+    return np.sqrt(squares)
+
+
+def misfit_surface(x, h, h1, h2, L, log_K, W, q=None, q_weight=1.0):
+    # rms misfit (m) of the model heads on the grid log_K x W, shape
+    # (len(log_K), len(W)). With observed discharges q (m^2/day, at the same
+    # x) their squared misfit is added with the weight q_weight.
+    x, h, q = finite_observations(x, h, q)
+    if q is None:
+        xq = q = np.array([])
+    else:
+        keep = np.isfinite(q)
+        xq, q = x[keep], q[keep]
+    observations = tuple(np.ascontiguousarray(a).tobytes() for a in (x, h, xq, q))
+    return _misfit_surface(
+        observations,
+        float(h1),
+        float(h2),
+        float(L),
+        np.asarray(log_K, dtype=float).tobytes(),
+        np.asarray(W, dtype=float).tobytes(),
+        float(q_weight),
+    )
+
+
+def calibrate(x, h, h1, h2, L, q=None, n=41, levels=4, zoom=5, q_weight=1.0):
+    # best fitting (K, W) by a coarse-to-fine grid search: an n x n grid over
+    # the full range, then levels - 1 grids zoomed in by zoom around the best
+    # point of the one before. Returns K, W, the rms misfit, and the
+    # (log_K, W, misfit) surface of every level, the first for the heatmap.
+    # The surfaces are cached, so a repeated fit of the same data is free.
+    log_K = np.linspace(*LOG_K_RANGE, n)
+    W = np.linspace(*W_RANGE, n)
+    surfaces = []
+    for level in range(levels):
+        misfit = misfit_surface(x, h, h1, h2, L, log_K, W, q, q_weight)
+        surfaces.append((log_K, W, misfit))
+        i, j = np.unravel_index(np.nanargmin(misfit), misfit.shape)
+        # the next grid is zoom times smaller, centred on the best point
+        dK = (log_K[-1] - log_K[0]) / (2 * zoom)
+        dW = (W[-1] - W[0]) / (2 * zoom)
+        log_K = np.linspace(log_K[i] - dK, log_K[i] + dK, n)
+        W = np.linspace(W[j] - dW, W[j] + dW, n)
+    log_K, W, misfit = surfaces[-1]
+    i, j = np.unravel_index(np.nanargmin(misfit), misfit.shape)
+    return 10 ** log_K[i], W[j], misfit[i, j], surfaces
@@ -1,9 +1,10 @@
 # This file updates the figures. It is called by app.py
 
+from functools import lru_cache
+
 import numpy as np
-import plotly.figure_factory as ff
 import plotly.graph_objects as go
-from PIL import Image
+from plotly.subplots import make_subplots
 
 import calculations as calc
 
@@ -11,27 +12,114 @@ import calculations as calc
 def remove_mesh_points(X, Y, h1, h2, K, W, L):
     # This function is used for making flow arrows on the elevation plot.
     # This function removes mesh grid points that are outside the area we want to put arrows.
-    h = calc.get_h(
-        h1, h2, K, W, L, X[0]
-    )  # we need h, because we don't want to plot arrows above h
-
-    # Here we just iterate over our mesh points and see if they are outside of our desired area, and if so set them to None
-    if calc.get_h_max(h1, h2, K, W, L) >= 0:
-        for i in range(len(X)):
-            for j in range(len(X[0])):
-                if Y[i][j] > h[j]:
-                    X[i][j] = None
-                    Y[i][j] = None
-    else:
-        for i in range(len(X)):
-            for j in range(len(X[0])):
-                if Y[i][j] > h[j]:
-                    X[i][j] = None
-                    Y[i][j] = None
+    X = np.array(X, dtype=float)
+    Y = np.array(Y, dtype=float)
+    # we need h at every mesh point, because we don't want to plot arrows above h
+    h = calc.get_h(h1, h2, K, W, L, X)
+
+    # mesh points above the water table are set to NaN, all at once
+    above = Y > h
+    X[above] = np.nan
+    Y[above] = np.nan
 
     return [X, Y]
 
 
+def arrow_mesh(h, L, nx=8, ny=5):
+    # mesh of the flow arrows: nx columns across the profile and ny rows up to
+    # 5/6 of the highest water table; raise nx, ny for denser arrow fields
+    x_quiver = np.linspace(L / 8, L - (L / 8), nx)
+    y_quiver = np.linspace(0, (5 / 6) * max(h), ny)  # go to max y value
+    return np.meshgrid(x_quiver, y_quiver)
+
+
+def quiver_lines(X, Y, u, v, scale=0.1, arrow_scale=0.3, angle=np.pi / 9):
+    # The flow arrows as one line: the shafts (start, end, NaN) of all arrows
+    # followed by their heads (point1, end, point2, NaN), computed for all
+    # arrows at once. The geometry is that of plotly's create_quiver: shafts
+    # of scale * (u, v), heads of arrow_scale times the shaft length, opened
+    # by angle on either side. Arrows at NaN mesh points are NaN throughout.
+    x = np.ravel(X).astype(float)
+    y = np.ravel(Y).astype(float)
+    end_x = x + scale * np.ravel(u)
+    end_y = y + scale * np.ravel(v)
+    dif_x = end_x - x
+    dif_y = end_y - y
+
+    head_len = arrow_scale * np.hypot(dif_x, dif_y)
+    barb_ang = np.arctan2(dif_y, dif_x)
+    gap = np.full(x.shape, np.nan)
+
+    shafts_x = np.stack([x, end_x, gap], axis=1)
+    shafts_y = np.stack([y, end_y, gap], axis=1)
+    heads_x = np.stack(
+        [
+            end_x - head_len * np.cos(barb_ang + angle),
+            end_x,
+            end_x - head_len * np.cos(barb_ang - angle),
+            gap,
+        ],
+        axis=1,
+    )
+    heads_y = np.stack(
+        [
+            end_y - head_len * np.sin(barb_ang + angle),
+            end_y,
+            end_y - head_len * np.sin(barb_ang - angle),
+            gap,
+        ],
+        axis=1,
+    )
+    return (
+        np.concatenate([shafts_x.ravel(), heads_x.ravel()]),
+        np.concatenate([shafts_y.ravel(), heads_y.ravel()]),
+    )
+
+
+# the "what if" scenarios that can be compared with the current parameters,
+# as a label and a function of (h1, h2, K, W, L)
+COMPARISONS = {
+    "K_double": ("K \u00D7 2", lambda h1, h2, K, W, L: (h1, h2, 2 * K, W, L)),
+    "K_half": ("K \u00F7 2", lambda h1, h2, K, W, L: (h1, h2, K / 2, W, L)),
+    "W_double": ("W \u00D7 2", lambda h1, h2, K, W, L: (h1, h2, K, 2 * W, L)),
+    "W_zero": ("W = 0", lambda h1, h2, K, W, L: (h1, h2, K, 0, L)),
+}
+
+# number of traces of the elevation and q plots before the scenario overlays
+ELEVATION_TRACES = 4
+Q_TRACES = 2
+
+SCENARIO_COLORS = ["DarkOrange", "ForestGreen", "Crimson", "SlateGray", "Goldenrod"]
+
+
+def scenario_traces(h1, h2, K, W, L, compare, quantity):
+    # dashed lines of h or q ("h" or "q") for the compared scenarios, all
+    # evaluated in one call of calc.get_scenarios
+    if not compare:
+        return []
+    labels = [COMPARISONS[c][0] for c in compare]
+    scenarios = [COMPARISONS[c][1](h1, h2, K, W, L) for c in compare]
+    x, h, q, d = calc.get_scenarios(scenarios)
+    y = h if quantity == "h" else q
+    return [
+        go.Scatter(
+            x=x[i],
+            y=y[i],
+            mode="lines",
+            line=dict(color=SCENARIO_COLORS[i % len(SCENARIO_COLORS)], dash="dash"),
+            name=labels[i],
+        )
+        for i in range(len(scenarios))
+    ]
+
+
+def overlay_scenarios(figure, first, traces):
+    # replace the overlay traces (from index first on) of the figure
+    figure.data = figure.data[:first]
+    figure.add_traces(traces)
+    return figure
+
+
 def get_topography_line(x, h):
     # This is creating the topography line on the elevation plot. This is a static line at random points I chose that look okay.
     shift = np.array([50, 51, 54, 54, 51, 51, 52, 52, 49, 48])
@@ -44,13 +132,16 @@ def get_topography_line(x, h):
     return topography_line
 
 
-def initialize_elevation_plot(h1, h2, K, W, L, arrow_visibility):
+def initialize_elevation_plot(
+    h1, h2, K, W, L, arrow_visibility, background="assets/background.png", compare=()
+):
     elevation_plot = go.Figure()
 
     elevation_plot.add_layout_image(
-        # setting the background image of the plot.
+        # setting the background image of the plot. It is referenced by url
+        # (served from the assets folder), so only the url is part of the figure.
         dict(
-            source=Image.open("./background.png"),
+            source=background,
             xref="x domain",
             yref="y domain",
             x=0,
@@ -110,26 +201,24 @@ def initialize_elevation_plot(h1, h2, K, W, L, arrow_visibility):
 
     if "visible" in arrow_visibility:  # if the checkbox for arrows is clicked
         # quiver plot
-        x_quiver = np.linspace(L / 8, L - (L / 8), 8)
-        y_quiver = np.linspace(0, (5 / 6) * max(h), 5)  # go to max y value
-        X, Y = np.meshgrid(x_quiver, y_quiver)
+        X, Y = arrow_mesh(h, L)
         X, Y = remove_mesh_points(
             X, Y, h1, h2, K, W, L
         )  # removing mesh points outside of the area we want arrows
         u = calc.get_q(h1, h2, K, W, L, X) * 15  # the arrows are scaled by 15
         v = Y * 0
-        # see https://plotly.github.io/plotly.py-docs/generated/plotly.figure_factory.create_quiver.html
-        quiver_plot = ff.create_quiver(
-            X,
-            Y,
-            u,
-            v,
-            arrow_scale=0.3,
-            angle=np.pi / (9 * 16),
-            name="Q(x)",
-            line_color="Teal",
+        x_arrows, y_arrows = quiver_lines(
+            X, Y, u, v, arrow_scale=0.3, angle=np.pi / (9 * 16)
+        )
+        elevation_plot.add_trace(
+            go.Scatter(
+                x=x_arrows,
+                y=y_arrows,
+                mode="lines",
+                line=dict(color="Teal"),
+                name="Q(x)",
+            )
         )
-        elevation_plot.add_traces(data=quiver_plot.data)
 
     # topography line
     elevation_plot.add_trace(get_topography_line(x, h))
@@ -165,10 +254,243 @@ def initialize_elevation_plot(h1, h2, K, W, L, arrow_visibility):
         bgcolor="lightgrey",
     )
 
+    # dashed heads of the compared scenarios
+    elevation_plot.add_traces(scenario_traces(h1, h2, K, W, L, compare, "h"))
+
     return elevation_plot
 
 
-def initialize_q_plot(h1, h2, K, W, L):
+# number of snapshots of the transient run, i.e. positions of the time slider
+TRANSIENT_SNAPSHOTS = 41
+
+
+@lru_cache(maxsize=32)
+def transient_run(h1, h2, K, W, L):
+    # the water table after the recharge W is switched on, starting from the
+    # steady state without recharge, over the response time of the aquifer.
+    # The snapshots are kept so the time slider never re-solves.
+    x = np.linspace(0, L, 201)
+    h0 = calc.get_h(h1, h2, K, 0, L, x)
+    t = np.linspace(0, calc.response_time(h1, h2, K, L), TRANSIENT_SNAPSHOTS)
+    x, h, converged = calc.get_h_transient(h0, h1, h2, K, W, L, t)
+    return x, t, h, converged
+
+
+def transient_title(t, converged, step):
+    # the time of the snapshot, and a warning when the solver did not
+    # converge on the way to it
+    title = "Water table after " + str(round(t[step])) + " days"
+    if not converged[step]:
+        title += " (solver did not converge)"
+    return title
+
+
+def initialize_transient_plot(h1, h2, K, W, L, step):
+    transient_plot = go.Figure()
+    x, t, h, converged = transient_run(h1, h2, K, W, L)
+
+    # plot the water table at the selected time
+    transient_plot.add_trace(
+        go.Scatter(x=x, y=h[step], line=dict(color="RoyalBlue"), name="h(x, t)")
+    )
+    # plot the steady state it approaches
+    transient_plot.add_trace(
+        go.Scatter(
+            x=x,
+            y=calc.get_h(h1, h2, K, W, L, x),
+            line=dict(color="RoyalBlue", dash="dash"),
+            name="steady state",
+        )
+    )
+    # plot the initial water table
+    transient_plot.add_trace(
+        go.Scatter(
+            x=x, y=h[0], line=dict(color="Gray", dash="dot"), name="initial (W = 0)"
+        )
+    )
+
+    transient_plot.update_layout(xaxis_title="x (m)", yaxis_title="h (m)")
+    transient_plot.update_xaxes(range=[0, L])
+    transient_plot.update_yaxes(range=[0, 65])
+    transient_plot.layout.title = transient_title(t, converged, step)
+
+    transient_plot.update_layout(margin=dict(l=100, r=150, b=50, t=50))
+
+    return transient_plot
+
+
+# thickness of the aquifer section (m)
+SECTION_DEPTH = 50
+
+
+def section_K(K, L):
+    # layered aquifer for the section plot: K above, K / 10 in the lower half
+    # and a clay lens of K / 1000 in the middle of the upper layer
+    zones = [
+        (0, L, 0, SECTION_DEPTH / 2, K / 10),
+        (0.4 * L, 0.6 * L, 0.6 * SECTION_DEPTH, 0.8 * SECTION_DEPTH, K / 1000),
+    ]
+    return calc.zoned_K(K, zones, L, SECTION_DEPTH)
+
+
+def section_arrows(x, z, qx, qz, every_x=10, every_z=5):
+    # flow arrows on every few cells of the section, the longest as long as
+    # 0.8 of the arrow spacing
+    X, Z = np.meshgrid(x[every_x // 2 :: every_x], z[every_z // 2 :: every_z])
+    u = qx[every_z // 2 :: every_z, every_x // 2 :: every_x]
+    v = qz[every_z // 2 :: every_z, every_x // 2 :: every_x]
+    scale = 0.8 * (x[every_x] - x[0]) / max(np.max(np.hypot(u, v)), 1e-12)
+    return quiver_lines(X, Z, u, v, scale=scale, arrow_scale=0.3)
+
+
+def initialize_section_plot(h1, h2, K, W, L):
+    section_plot = go.Figure()
+    x, z, h, qx, qz = calc.get_section(h1, h2, W, section_K(K, L), L, SECTION_DEPTH)
+
+    # plot the heads as contours
+    section_plot.add_trace(
+        go.Contour(
+            x=x,
+            y=z,
+            z=h,
+            colorscale="Blues",
+            contours=dict(showlabels=True),
+            colorbar=dict(title="h (m)"),
+            name="h(x, z)",
+        )
+    )
+    # plot the flow arrows
+    x_arrows, y_arrows = section_arrows(x, z, qx, qz)
+    section_plot.add_trace(
+        go.Scatter(
+            x=x_arrows,
+            y=y_arrows,
+            mode="lines",
+            line=dict(color="Teal"),
+            name="flow",
+        )
+    )
+
+    section_plot.update_layout(xaxis_title="x (m)", yaxis_title="z (m)")
+    section_plot.update_xaxes(range=[0, L])
+    section_plot.update_yaxes(range=[0, SECTION_DEPTH])
+    section_plot.layout.title = "Layered Aquifer Section"
+
+    section_plot.update_layout(margin=dict(l=100, r=150, b=50, t=50))
+
+    return section_plot
+
+
+def nan_join(x, y):
+    # rows of x and y as one line, the rows separated by NaN
+    gap = np.full((x.shape[0], 1), np.nan)
+    return np.hstack([x, gap]).ravel(), np.hstack([y, gap]).ravel()
+
+
+def particle_traces(h1, h2, K, W, L, every=50):
+    # travel time against release point for all particles, and the
+    # pathlines of every few of them as one NaN-separated line
+    x0, T, x, z, t = calc.track_particles(h1, h2, K, W, L)
+    x_paths, z_paths = nan_join(x[every // 2 :: every], z[every // 2 :: every])
+    return x0, T, x_paths, z_paths
+
+
+def initialize_particle_plot(h1, h2, K, W, L):
+    particle_plot = make_subplots(rows=2, cols=1, shared_xaxes=True)
+    x0, T, x_paths, z_paths = particle_traces(h1, h2, K, W, L)
+    x = np.linspace(0, L, 1000)
+
+    # plot the water table and the pathlines below it
+    particle_plot.add_trace(
+        go.Scatter(
+            x=x,
+            y=calc.get_h(h1, h2, K, W, L, x),
+            line=dict(color="RoyalBlue"),
+            name="h(x)",
+        ),
+        row=1,
+        col=1,
+    )
+    particle_plot.add_trace(
+        go.Scatter(
+            x=x_paths,
+            y=z_paths,
+            mode="lines",
+            line=dict(color="Teal", width=1),
+            name="pathlines",
+        ),
+        row=1,
+        col=1,
+    )
+    # plot the travel time to the boundaries against the release point
+    particle_plot.add_trace(
+        go.Scatter(x=x0, y=T, line=dict(color="DarkOrange"), name="travel time"),
+        row=2,
+        col=1,
+    )
+
+    particle_plot.update_xaxes(range=[0, L])
+    particle_plot.update_xaxes(title_text="release point x (m)", row=2, col=1)
+    particle_plot.update_yaxes(title_text="z (m)", range=[0, 65], row=1, col=1)
+    particle_plot.update_yaxes(
+        title_text="travel time (days)", type="log", row=2, col=1
+    )
+    particle_plot.layout.title = "Particle Paths and Travel Times"
+
+    particle_plot.update_layout(height=600, margin=dict(l=100, r=150, b=50, t=50))
+
+    return particle_plot
+
+
+def calibration_plot(surfaces=None, K=None, W=None):
+    # heatmap of the misfit on the coarse (K, W) grid of a calibration and
+    # the best fit. Without a calibration the figure is empty.
+    calibration_plot = go.Figure()
+
+    if surfaces is not None:
+        log_K, Ws, misfit = surfaces[0]
+        calibration_plot.add_trace(
+            go.Heatmap(
+                x=Ws,
+                y=log_K,
+                z=np.log10(np.maximum(misfit, 1e-12)),
+                colorscale="Viridis_r",
+                colorbar=dict(title="log\u2081\u2080 rms misfit (m)"),
+                name="misfit",
+            )
+        )
+        # the refined grids, as outlines
+        for log_K, Ws, misfit in surfaces[1:]:
+            calibration_plot.add_trace(
+                go.Scatter(
+                    x=[Ws[0], Ws[-1], Ws[-1], Ws[0], Ws[0]],
+                    y=[log_K[0], log_K[0], log_K[-1], log_K[-1], log_K[0]],
+                    mode="lines",
+                    line=dict(color="White", width=1),
+                    showlegend=False,
+                )
+            )
+        calibration_plot.add_trace(
+            go.Scatter(
+                x=[W],
+                y=[np.log10(K)],
+                mode="markers",
+                marker=dict(color="Red", size=10, symbol="x"),
+                name="best fit",
+            )
+        )
+
+    calibration_plot.update_layout(
+        xaxis_title="W (m/day)", yaxis_title="log\u2081\u2080 K (m/day)"
+    )
+    calibration_plot.layout.title = "Calibration Misfit"
+
+    calibration_plot.update_layout(margin=dict(l=100, r=150, b=50, t=50))
+
+    return calibration_plot
+
+
+def initialize_q_plot(h1, h2, K, W, L, compare=()):
     q_plot = go.Figure()
 
     # calculating values for our parameters using the calculations file.
@@ -196,10 +518,15 @@ def initialize_q_plot(h1, h2, K, W, L):
 
     q_plot.update_layout(margin=dict(l=100, r=150, b=50, t=50))
 
+    # dashed q of the compared scenarios
+    q_plot.add_traces(scenario_traces(h1, h2, K, W, L, compare, "q"))
+
     return q_plot
 
 
-def update_elevation_plot(h1, h2, K, W, L, arrow_visibility, elevation_plot):
+def update_elevation_plot(
+    h1, h2, K, W, L, arrow_visibility, elevation_plot, compare=()
+):
     # calculating our parameters with the calculations file.
     x = np.linspace(0, L, 1000)
     h = calc.get_h(h1, h2, K, W, L, x)
@@ -224,18 +551,16 @@ def update_elevation_plot(h1, h2, K, W, L, arrow_visibility, elevation_plot):
     # update flow arrows
     if "visible" in arrow_visibility:
         # quiver plot
-        x_quiver = np.linspace(L / 8, L - (L / 8), 8)
-        y_quiver = np.linspace(0, (5 / 6) * max(h), 5)  # go to max y value
-        X, Y = np.meshgrid(x_quiver, y_quiver)
+        X, Y = arrow_mesh(h, L)
         X, Y = remove_mesh_points(X, Y, h1, h2, K, W, L)
         u = calc.get_q(h1, h2, K, W, L, X) * 15
         v = Y * 0
-        quiver_plot = ff.create_quiver(
+        x_arrows, y_arrows = quiver_lines(
             X, Y, u, v, arrow_scale=0.3, angle=np.pi / (9 * 16)
         )
 
-        elevation_plot.data[2].x = quiver_plot.data[0].x
-        elevation_plot.data[2].y = quiver_plot.data[0].y
+        elevation_plot.data[2].x = x_arrows
+        elevation_plot.data[2].y = y_arrows
     else:
         elevation_plot.data[2].x = []
         elevation_plot.data[2].y = []
@@ -261,10 +586,16 @@ def update_elevation_plot(h1, h2, K, W, L, arrow_visibility, elevation_plot):
     )
     elevation_plot.update_annotations(text=text)
 
+    overlay_scenarios(
+        elevation_plot,
+        ELEVATION_TRACES,
+        scenario_traces(h1, h2, K, W, L, compare, "h"),
+    )
+
     return elevation_plot
 
 
-def update_q_plot(h1, h2, K, W, L, q_plot):
+def update_q_plot(h1, h2, K, W, L, q_plot, compare=()):
     x = np.linspace(0, L, 1000)
     q = calc.get_q(h1, h2, K, W, L, x)
 
@@ -273,4 +604,57 @@ def update_q_plot(h1, h2, K, W, L, q_plot):
 
     q_plot.update_xaxes(range=[0, L])
 
+    overlay_scenarios(q_plot, Q_TRACES, scenario_traces(h1, h2, K, W, L, compare, "q"))
+
     return q_plot
+
+
+def update_transient_plot(h1, h2, K, W, L, step, transient_plot):
+    # the run is only solved when the parameters change; moving the time
+    # slider picks another of the stored snapshots
+    x, t, h, converged = transient_run(h1, h2, K, W, L)
+
+    transient_plot.data[0].x = x
+    transient_plot.data[0].y = h[step]
+    transient_plot.data[1].x = x
+    transient_plot.data[1].y = calc.get_h(h1, h2, K, W, L, x)
+    transient_plot.data[2].x = x
+    transient_plot.data[2].y = h[0]
+
+    transient_plot.update_xaxes(range=[0, L])
+    transient_plot.layout.title = transient_title(t, converged, step)
+
+    return transient_plot
+
+
+def update_section_plot(h1, h2, K, W, L, section_plot):
+    # the section system is only factorized again when K or L change
+    x, z, h, qx, qz = calc.get_section(h1, h2, W, section_K(K, L), L, SECTION_DEPTH)
+
+    section_plot.data[0].x = x
+    section_plot.data[0].y = z
+    section_plot.data[0].z = h
+
+    x_arrows, y_arrows = section_arrows(x, z, qx, qz)
+    section_plot.data[1].x = x_arrows
+    section_plot.data[1].y = y_arrows
+
+    section_plot.update_xaxes(range=[0, L])
+
+    return section_plot
+
+
+def update_particle_plot(h1, h2, K, W, L, particle_plot):
+    x0, T, x_paths, z_paths = particle_traces(h1, h2, K, W, L)
+    x = np.linspace(0, L, 1000)
+
+    particle_plot.data[0].x = x
+    particle_plot.data[0].y = calc.get_h(h1, h2, K, W, L, x)
+    particle_plot.data[1].x = x_paths
+    particle_plot.data[1].y = z_paths
+    particle_plot.data[2].x = x0
+    particle_plot.data[2].y = T
+
+    particle_plot.update_xaxes(range=[0, L])
+
+    return particle_plot
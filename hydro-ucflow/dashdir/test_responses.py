@@ -0,0 +1,53 @@
+# Checks that the callback responses of the app carry no image data: the
+# background of the elevation plot is referenced by url and served (with
+# long-lived cache headers) from the assets route.
+# Run from this directory with `python -m pytest test_responses.py`.
+
+import json
+
+import app
+
+
+def update_elevation_plot(client, **values):
+    # request the elevation figure like the browser does on a slider move
+    inputs = [
+        {"id": name, "property": "value", "value": value}
+        for name, value in values.items()
+    ]
+    body = {
+        "output": "elevation_plot.figure",
+        "outputs": {"id": "elevation_plot", "property": "figure"},
+        "inputs": inputs,
+        "changedPropIds": ["h1.value"],
+    }
+    return client.post("/_dash-update-component", json=body)
+
+
+def test_callback_response_has_no_image_bytes():
+    client = app.server.test_client()
+    response = update_elevation_plot(
+        client,
+        h1=app.initial_h1,
+        h2=app.initial_h2,
+        K=app.initial_K,
+        W=app.initial_W,
+        L=app.initial_L,
+        arrow_visibility=app.initial_arrow_visibility,
+        compare=app.initial_compare,
+    )
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    assert "data:image" not in text
+    assert "base64" not in text
+
+    figure = json.loads(text)["response"]["elevation_plot"]["figure"]
+    source = figure["layout"]["images"][0]["source"]
+    assert source == app.background_url
+
+
+def test_background_is_cached():
+    client = app.server.test_client()
+    url = app.background_url.split("?")[0].replace("/hydro/", "/", 1)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.max_age >= 365 * 24 * 3600
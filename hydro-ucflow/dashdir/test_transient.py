@@ -0,0 +1,30 @@
+# Checks of the transient water table: the implicit steps converge also
+# when discharge dries out part of the aquifer, and the run settles to the
+# steady state of get_h.
+# Run from this directory with `python -m pytest test_transient.py`.
+
+import numpy as np
+
+import calculations as calc
+
+
+def transient(K, W, h1=35, h2=30, L=800):
+    x = np.linspace(0, L, 201)
+    h0 = calc.get_h(h1, h2, K, 0, L, x)
+    t = np.linspace(0, 4 * calc.response_time(h1, h2, K, L), 41)
+    return calc.get_h_transient(h0, h1, h2, K, W, L, t)
+
+
+def test_drying_aquifer_converges():
+    for K in [0.01, 0.1, 1]:
+        _, h, converged = transient(K, -0.05)
+        assert converged.all()
+        assert h.min() == 0
+        assert (h >= 0).all()
+
+
+def test_run_settles_to_steady_state():
+    for K, W in [(0.1, 0.05), (10, 0.1), (10, -0.02)]:
+        x, h, converged = transient(K, W)
+        assert converged.all()
+        np.testing.assert_allclose(h[-1], calc.get_h(35, 30, K, W, 800, x), atol=1e-3)